@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# benchmark of the fit pipeline on synthetic sidereal histograms
+#
+# writes --n_toys toy files to a temporary directory and times every stage
+# of the per-toy loop with the stages liv_fit_to_data books: file open and
+# histogram get, dataset build, fit, chi2, residuals and output writing,
+# then every model fitted alone and the batch fit of the whole ensemble.
+# Results are saved as json, --compare prints the change against an earlier
+# run. Runs offline, the roofit engine needs ROOT.
+
+import sys
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+from liv_models import models
+import liv_fast_fit
+from liv_fit_to_data import RooFitModels, arrays_to_hist, fit_hist, import_root, make_parser
+from liv_hist_reader import NpzReader, PackReader, write_npz, write_pack
+from liv_memory import peak_rss_mb
+from liv_profiling import percentiles, timer
+from liv_result_writer import TxtWriter, writers
+from liv_toy_gen import flat_reference, generate_toys
+
+def make_inputs(work_dir, n_toys, n_bins, seed=0, input_format="npz"):
+    #synthetic toy files of a flat double ratio, returns (reader, keys)
+    edges, contents, sumw2 = flat_reference(n_bins)
+    toys = generate_toys(contents, np.sqrt(sumw2), range(n_toys), seed)
+    paths = []
+    for toy_ID, toy in enumerate(toys):
+        paths.append(os.path.join(work_dir, f"toy_seed_{toy_ID}.npz"))
+        write_npz(paths[-1], {"h_generated": (edges, toy, sumw2)})
+    if input_format == "pack":
+        write_pack(os.path.join(work_dir, "pack"), NpzReader(), paths, list(range(n_toys)))
+        return PackReader(os.path.join(work_dir, "pack")), list(range(n_toys))
+    return NpzReader(), paths
+
+
+def make_writer(work_dir, output_format):
+    path = os.path.join(work_dir, f"results.{output_format}")
+    if output_format == "txt":
+        return TxtWriter(path, os.path.join(work_dir, "residuals.txt"))
+    return writers[output_format](path)
+
+
+def bench_toys(reader, keys, writer, engine="numpy"):
+    #time the per-toy loop of liv_fit_to_data with the pipeline timer, fit_hist
+    #and the readers (open, get) book their own stages. The options are the
+    #defaults of liv_fit_to_data
+    args = make_parser().parse_args(["--input_list", os.devnull, "--output", os.devnull, "--engine", engine])
+    timer.enable()
+    roofit_models = RooFitModels() if engine == "roofit" else None
+    for toy_ID, key in enumerate(keys):
+        start = time.perf_counter()
+        hist = reader.read(key)
+        _, results, residuals = fit_hist(hist, toy_ID, roofit_models, args)
+        with timer.stage("write"):
+            writer.write(toy_ID, results, residuals)
+        timer.add("total", time.perf_counter() - start)
+        timer.end_toy(toy_ID)
+    start = time.perf_counter()
+    writer.close()
+    close = time.perf_counter() - start
+    summary = timer.summary()
+    timer.enable(False)
+    return summary, close
+
+
+def bench_models(reader, keys, engine="numpy"):
+    #the fit stage split by model, every model fitted alone to every toy. The
+    #numpy engine solves all models at once, so this is a pass of its own
+    timer.enable()
+    roofit_models = RooFitModels() if engine == "roofit" else None
+    templates = None
+    for toy_ID, key in enumerate(keys):
+        edges, contents, sumw2 = reader.read(key)
+        if engine == "roofit":
+            roofit_models.h = arrays_to_hist(edges, contents, sumw2, h=roofit_models.h)
+            roofit_models.set_data(roofit_models.h)
+        elif templates is None:
+            templates = liv_fast_fit.model_templates(edges)
+        timer.pop()
+        fits = {}
+        for i, model_str in enumerate(models):
+            start = time.perf_counter()
+            if engine == "roofit":
+                roofit_models.fit(model_str)
+            else:
+                liv_fast_fit.fit_models(edges, contents[None], np.sqrt(sumw2)[None], templates[i:i+1])
+            fits[f"fit:{model_str}"] = time.perf_counter() - start
+        #only the model totals, not the fit and chi2 stages of RooFitModels.fit
+        timer.pop()
+        timer.merge(fits)
+        timer.end_toy(toy_ID)
+    summary = timer.summary()
+    timer.enable(False)
+    return summary
+
+
+def bench_batch(reader, keys, repeat=3):
+    #read and fit the whole ensemble at once, best of repeat
+    best = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        edges, contents, sumw2 = reader.read_all(keys)
+        read = time.perf_counter()
+        liv_fast_fit.fit_ensemble(edges, contents, np.sqrt(sumw2))
+        fit = time.perf_counter()
+        for stage, seconds in [("read", read - start), ("fit", fit - read)]:
+            best[stage] = min(best.get(stage, seconds), seconds)
+    best["toys_per_sec"] = len(keys)/(best["read"] + best["fit"])
+    return best
+
+
+def print_report(report, reference=None):
+    print(f"{report['config']['n_toys']} toys, {report['config']['n_bins']} bins, engine {report['config']['engine']}: "
+          f"{report['toys_per_sec']:.1f} toys/s per toy, {report['batch']['toys_per_sec']:.1f} toys/s batch, "
+          f"peak RSS {report['peak_rss_mb']:.1f} MB")
+    for table, title in [("stages", "stage"), ("models", "model fit alone")]:
+        header = f"{title:22} {'mean ms':>10}" + "".join(f" {'p'+str(p)+' ms':>10}" for p in percentiles)
+        print(header + (f" {'vs ref':>8}" if reference else ""))
+        for stage, s in report[table].items():
+            line = f"{stage:22} {s['mean_ms']:10.4f}" + "".join(f" {s[f'p{p}_ms']:10.4f}" for p in percentiles)
+            if reference and stage in reference.get(table, {}):
+                line += f" {s['mean_ms']/reference[table][stage]['mean_ms']:8.2f}"
+            print(line)
+
+
+def benchmark(coms=None):
+    argparser = argparse.ArgumentParser(description='benchmark the fit pipeline on synthetic histograms')
+    argparser.add_argument('--n_toys', type=int, default=1000, help='number of synthetic toys')
+    argparser.add_argument('--n_bins', type=int, default=24, help='sday bins of the synthetic histograms')
+    argparser.add_argument('--seed', type=int, default=0, help='seed of the synthetic toys')
+    argparser.add_argument('--engine', default="numpy", choices=["roofit", "numpy"], help='fit engine')
+    argparser.add_argument('--input_format', default="npz", choices=["npz", "pack"],
+                           help='read the toys from npz files or from a pack')
+    argparser.add_argument('--output_format', default="csv", choices=sorted(writers), help='result writer')
+    argparser.add_argument('--work_dir', default=None, type=str,
+                           help='directory of the synthetic inputs and outputs, temporary if not given')
+    argparser.add_argument('--output', default="benchmark.json", type=str, help='json file of the results')
+    argparser.add_argument('--compare', default=None, type=str, help='json of an earlier run to compare with')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    if args.engine == "roofit":
+        try:
+            import_root()
+        except ImportError:
+            logging.error("ROOT is not available, benchmark the numpy engine!")
+            sys.exit()
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        start = time.perf_counter()
+        reader, keys = make_inputs(work_dir, args.n_toys, args.n_bins, args.seed, args.input_format)
+        generate = time.perf_counter() - start
+        stages, close = bench_toys(reader, keys, make_writer(work_dir, args.output_format), args.engine)
+        model_stages = bench_models(reader, keys, args.engine)
+        batch = bench_batch(reader, keys)
+
+    report = {"config": vars(args), "host": platform.node(), "python": platform.python_version(),
+              "numpy": np.__version__, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "generate_s": generate, "toys_per_sec": args.n_toys/stages["total"]["total_s"],
+              "stages": stages, "models": model_stages, "close_s": close, "batch": batch, "peak_rss_mb": peak_rss_mb()}
+    with open(args.output, 'w') as _f:
+        json.dump(report, _f, indent=1)
+
+    reference = None
+    if args.compare:
+        with open(args.compare, 'r') as _f:
+            reference = json.load(_f)
+    print_report(report, reference)
+    return report
+
+
+def main():
+    benchmark()
+
+if __name__=="__main__":
+    main()
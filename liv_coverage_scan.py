@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# bias, pull width and interval coverage versus injected mu, for every model
+#
+# each (model, mu) point draws its toys around the reference with the signal
+# 1+mu*T injected, fits that model to all of them in one batch and reduces
+# the results to one row. Points run on a process pool, every point has its
+# own random stream SeedSequence(seed, spawn_key=(model, mu index)), so the
+# table does not depend on --jobs.
+
+from concurrent.futures import ProcessPoolExecutor
+import sys
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from liv_models import models, load_extra_models
+import liv_fast_fit
+from liv_hist_reader import get_reader, readers
+from liv_toy_gen import flat_reference, inject
+
+scan_columns = ["model", "mu", "n_toys", "mean", "bias", "bias_err", "err_mean", "pull_mean", "pull_mean_err",
+                "pull_std", "coverage1", "coverage1_err", "coverage2", "coverage2_err", "chi2_p0_mean"]
+
+
+def asimov_errors(edges, contents, sumw2, model_list, integrate=False):
+    #error of mu of every model fitted to the reference itself
+    templates = liv_fast_fit.model_templates(edges, model_list, integrate)
+    return liv_fast_fit.fit_models(edges, contents, np.sqrt(sumw2), templates)["err"]
+
+
+def scan_point(point, reference, n_toys, seed=0, batch_size=10000, integrate=False):
+    """Fit n_toys toys of one (model, mu) point and reduce them to a row of scan_columns."""
+    i_model, i_mu, model_str, mu = point
+    edges, contents, sumw2 = reference
+    sigma = np.sqrt(sumw2)
+    expected = inject(edges, contents, model_str, mu, integrate)
+    template = liv_fast_fit.model_templates(edges, [model_str], integrate)
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i_model, i_mu)))
+
+    par, err, chi2_p0 = [], [], []
+    for start in range(0, n_toys, batch_size):
+        n = min(batch_size, n_toys - start)
+        toys = expected + sigma*rng.standard_normal((n, len(expected)))
+        fit = liv_fast_fit.fit_models(edges, toys, np.broadcast_to(sigma, toys.shape), template)
+        par.append(fit["par"][:, 0])
+        err.append(fit["err"][:, 0])
+        chi2_p0.append(fit["chi2_p0"][:, 0])
+    par, err, chi2_p0 = np.concatenate(par), np.concatenate(err), np.concatenate(chi2_p0)
+
+    pull = (par - mu)/err
+    coverage1 = np.mean(np.abs(pull) < 1)
+    coverage2 = np.mean(np.abs(pull) < 2)
+    return [model_str, mu, n_toys, par.mean(), par.mean() - mu, par.std(ddof=1)/np.sqrt(n_toys), err.mean(),
+            pull.mean(), pull.std(ddof=1)/np.sqrt(n_toys), pull.std(ddof=1),
+            coverage1, np.sqrt(coverage1*(1-coverage1)/n_toys), coverage2, np.sqrt(coverage2*(1-coverage2)/n_toys),
+            chi2_p0.mean()]
+
+
+def linearity(rows):
+    #weighted straight line fitted mean = offset + slope*mu per model
+    out = {}
+    for model_str in dict.fromkeys(row[0] for row in rows):
+        mu, mean, mean_err = np.array([(row[1], row[3], row[5]) for row in rows if row[0] == model_str]).T
+        if len(mu) < 2:
+            continue
+        slope, offset = np.polyfit(mu, mean, 1, w=1./mean_err)
+        out[model_str] = (slope, offset)
+    return out
+
+
+def write_table(rows, path):
+    #json list of row dicts for a .json path, csv otherwise
+    if path.endswith(".json"):
+        with open(path, 'w') as _f:
+            json.dump([dict(zip(scan_columns, [row[0], row[1], row[2]] + [float(x) for x in row[3:]])) for row in rows], _f, indent=1)
+        return
+    with open(path, 'w') as _f:
+        _f.write(','.join(f'"{c}"' for c in scan_columns)+'\n')
+        for row in rows:
+            _f.write(','.join([f'"{row[0]}"', repr(row[1]), str(row[2])] + [repr(float(x)) for x in row[3:]])+'\n')
+
+
+def _init_worker(extra_models):
+    if extra_models:
+        load_extra_models(extra_models)
+
+
+def _scan_worker(task):
+    point, reference, args = task
+    return scan_point(point, reference, args.n_toys, args.seed, args.batch_size, args.integrate_bins)
+
+
+def coverage_scan(coms=None):
+    argparser = argparse.ArgumentParser(description='bias and coverage scan over injected mu')
+    argparser.add_argument('--reference', default=None, type=str,
+                           help='file with the Asimov/reference histogram, flat 1 if not given')
+    argparser.add_argument('--h_name', default="h_generated", help='histogram name')
+    argparser.add_argument('--reader', default="root", choices=sorted(readers),
+                           help='reader of the reference, uproot and npz run without ROOT')
+    argparser.add_argument('--n_bins', type=int, default=24, help='bins of the flat reference')
+    argparser.add_argument('--rel_error', type=float, default=1e-3, help='bin error of the flat reference')
+    argparser.add_argument('--models', default=None, nargs='+', type=str, help='models to scan, all by default')
+    argparser.add_argument('--extra_models', default=None, type=str,
+                           help='json file {name: [cos, sin, cos2, sin2]} of additional models')
+    argparser.add_argument('--mu_range', type=float, nargs=2, default=[-5., 5.], help='range of injected mu')
+    argparser.add_argument('--n_points', type=int, default=20, help='number of mu points')
+    argparser.add_argument('--units', default="sigma", choices=["sigma", "mu"],
+                           help='--mu_range in units of the Asimov error of each model, or in mu')
+    argparser.add_argument('--n_toys', type=int, default=10000, help='toys per point')
+    argparser.add_argument('--batch_size', type=int, default=10000, help='toys fitted at once')
+    argparser.add_argument('--seed', type=int, default=0, help='seed of the toy random streams')
+    argparser.add_argument('--integrate_bins', action='store_true', default=False,
+                           help='inject and fit the model averaged over each bin')
+    argparser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    argparser.add_argument('--output', default="coverage_scan.csv", type=str, help='csv or .json table, one row per point')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    if args.extra_models:
+        load_extra_models(args.extra_models)
+    model_list = args.models or list(models)
+    unknown = [model_str for model_str in model_list if model_str not in models]
+    if unknown:
+        logging.error(f"unknown models {unknown}!")
+        sys.exit()
+
+    if args.reference:
+        reference = get_reader(args.reader, args.h_name).read(args.reference)
+    else:
+        reference = flat_reference(args.n_bins, args.rel_error)
+    reference = tuple(np.asarray(x, dtype=float) for x in reference)
+
+    grid = np.linspace(args.mu_range[0], args.mu_range[1], args.n_points)
+    scale = asimov_errors(*reference, model_list, args.integrate_bins) if args.units == "sigma" else np.ones(len(model_list))
+    points = [(models.index(model_str), i_mu, model_str, float(mu*scale[i]))
+              for i, model_str in enumerate(model_list) for i_mu, mu in enumerate(grid)]
+    tasks = [(point, reference, args) for point in points]
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                                 initargs=(args.extra_models,)) as pool:
+            rows = list(pool.map(_scan_worker, tasks, chunksize=max(1, len(tasks)//(4*args.jobs))))
+    else:
+        rows = [_scan_worker(task) for task in tasks]
+
+    write_table(rows, args.output)
+
+    print(f"{len(points)} points of {args.n_toys} toys, table in {args.output}")
+    print(f"{'model':14} {'slope':>8} {'max|pull mean|':>14} {'pull std':>15} {'cov 1s':>15}")
+    for model_str, (slope, offset) in linearity(rows).items():
+        model_rows = [row for row in rows if row[0] == model_str]
+        pull_std = [row[9] for row in model_rows]
+        coverage1 = [row[10] for row in model_rows]
+        print(f"{model_str:14} {slope:8.4f} {max(abs(row[7]) for row in model_rows):14.3f} "
+              f"{min(pull_std):7.3f}-{max(pull_std):<7.3f} {min(coverage1):7.3f}-{max(coverage1):<7.3f}")
+    return rows
+
+
+def main():
+    coverage_scan()
+
+if __name__=="__main__":
+    main()
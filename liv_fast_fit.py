@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# closed-form chi2 fit of the sidereal models.
+#
+# Every model is 1+mu*T(sday) with a fixed template T, so the chi2 used by
+# RooFit (data vs. N*binwidth*pdf, SumW2 errors, pdf evaluated at the bin
+# centre) is an exact parabola in mu. Minimum, error and chi2 at the minimum
+# follow from weighted least squares and all models are fitted at once.
+# Arrays may carry leading toy axes: contents/errors have shape (..., n_bins).
+# p-values use scipy.special, importing scipy.stats costs ~1 s of startup.
+
+import collections
+import functools
+
+import numpy as np
+from scipy import special
+
+from liv_models import basis_functions, models, get_model_vector
+from liv_profiling import timer
+
+
+def bin_centres(edges):
+    edges = np.asarray(edges, dtype=float)
+    return 0.5*(edges[1:] + edges[:-1])
+
+
+@functools.lru_cache(maxsize=32)
+def _sidereal_basis(edges, integrate):
+    edges = np.array(edges)
+    k = np.arange(1, len(basis_functions)//2+1)[:, None]
+    if integrate:
+        #average of each harmonic over the bin
+        low, high, width = edges[:-1], edges[1:], np.diff(edges)
+        cos = (np.sin(k*high) - np.sin(k*low))/(k*width)
+        sin = (np.cos(k*low) - np.cos(k*high))/(k*width)
+    else:
+        x = bin_centres(edges)
+        cos, sin = np.cos(k*x), np.sin(k*x)
+    basis = np.stack([cos, sin], axis=1).reshape(len(basis_functions), -1)
+    basis.setflags(write=False)
+    return basis
+
+
+def sidereal_basis(edges, integrate=False):
+    """cos/sin of the first two sidereal harmonics per bin, (4, n_bins).
+
+    Rows follow liv_models.basis_functions. Evaluated at the bin centres,
+    or averaged over each bin with integrate=True (RooFit IntegrateBins).
+    Cached per binning, the returned array is read-only.
+    """
+    return _sidereal_basis(tuple(np.asarray(edges, dtype=float).tolist()), bool(integrate))
+
+
+def model_templates(edges, model_list=None, integrate=False):
+    """Return T of shape (n_models, n_bins), every model is a vector against the basis."""
+    if model_list is None:
+        model_list = models
+    vectors = np.array([get_model_vector(model_str) for model_str in model_list])
+    return vectors @ sidereal_basis(edges, integrate)
+
+
+def expected_scale(edges, contents):
+    """N*binwidth/range, the prediction of the normalised pdf for mu=0."""
+    edges = np.asarray(edges, dtype=float)
+    widths = np.diff(edges)
+    total = np.sum(contents, axis=-1, keepdims=True)
+    return total*widths/(edges[-1] - edges[0])
+
+
+def fit_models(edges, contents, errors, templates=None):
+    """Fit every template to every histogram.
+
+    Returns a dict of arrays with shape (..., n_models): par, err, chi2,
+    chi2_p0, plus the per-bin scale used for the prediction.
+    """
+    contents = np.asarray(contents, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    if templates is None:
+        templates = model_templates(edges)
+
+    weight = np.zeros_like(errors)
+    np.divide(1., errors**2, out=weight, where=errors > 0)
+    scale = expected_scale(edges, contents)
+    resid0 = contents - scale
+
+    # chi2(mu) = S - 2*mu*G + mu^2*F
+    F = np.einsum('...n,mn->...m', weight*scale**2, templates**2)
+    G = np.einsum('...n,mn->...m', weight*scale*resid0, templates)
+    S = np.sum(weight*resid0**2, axis=-1, keepdims=True)
+
+    par = G/F
+    err = 1./np.sqrt(F)
+    chi2 = np.maximum(S - G*par, 0.)
+    degree_freedom = contents.shape[-1] - 1
+    chi2_p0 = special.chdtrc(degree_freedom, chi2)
+    return {"par": par, "err": err, "chi2": chi2, "chi2_p0": chi2_p0,
+            "scale": scale}
+
+
+def fit_joint(edges, contents, errors, templates):
+    """Fit all templates simultaneously, 1+sum_j mu_j*T_j, to every histogram.
+
+    The chi2 is quadratic in the mu_j, so the fit is one batched solve of
+    the normal equations F mu = G. Returns a dict with par, err of shape
+    (..., n_par), cov of shape (..., n_par, n_par), chi2 and chi2_p0 of
+    shape (...) and the per-bin scale.
+    """
+    contents = np.asarray(contents, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    templates = np.atleast_2d(templates)
+
+    weight = np.zeros_like(errors)
+    np.divide(1., errors**2, out=weight, where=errors > 0)
+    scale = expected_scale(edges, contents)
+    resid0 = contents - scale
+
+    # chi2(mu) = S - 2*mu.G + mu.F.mu
+    F = np.einsum('...n,in,jn->...ij', weight*scale**2, templates, templates)
+    G = np.einsum('...n,in->...i', weight*scale*resid0, templates)
+    S = np.sum(weight*resid0**2, axis=-1)
+
+    cov = np.linalg.inv(F)
+    par = np.einsum('...ij,...j->...i', cov, G)
+    chi2 = np.maximum(S - np.einsum('...i,...i->...', G, par), 0.)
+    degree_freedom = contents.shape[-1] - len(templates)
+    chi2_p0 = special.chdtrc(degree_freedom, chi2)
+    return {"par": par, "err": np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1)), "cov": cov,
+            "chi2": chi2, "chi2_p0": chi2_p0, "scale": scale}
+
+
+def predict(scale, par, templates):
+    """Fitted model per bin, shape (..., n_models, n_bins)."""
+    return scale[..., None, :]*(1. + np.asarray(par)[..., None]*templates)
+
+
+def profile_scan(par, err, chi2=0., n_points=1000, n_sigma=3.):
+    """Exact chi2 profile of mu on a grid of +-n_sigma errors.
+
+    The chi2 is a parabola in mu, so the profile is chi2 + ((mu-par)/err)^2
+    and needs no minimisation. Returns (mu_grid, dchi2, chi2 + dchi2), each of
+    shape (..., n_points).
+    """
+    par = np.asarray(par, dtype=float)[..., None]
+    err = np.asarray(err, dtype=float)[..., None]
+    mu_grid = par + err*np.linspace(-n_sigma, n_sigma, n_points)
+    dchi2 = ((mu_grid - par)/err)**2
+    return mu_grid, dchi2, np.asarray(chi2, dtype=float)[..., None] + dchi2
+
+
+def profile_intervals(par, err, levels=(1, 2)):
+    """Crossings of dchi2 = n^2 for every n in levels, as {n: (low, high)}."""
+    par = np.asarray(par, dtype=float)
+    err = np.asarray(err, dtype=float)
+    return {n: (par - n*err, par + n*err) for n in levels}
+
+
+n_fourier_harmonics = 4
+
+def residual_stats(edges, contents, errors, fit, templates, diagnostics=False):
+    """Residual statistics of all models from the bin arrays, no plot frames.
+
+    res_mean/res_std are the mean and std of data-fit per model and
+    res_err_mean the mean data error. With diagnostics, also per model the
+    mean/std of the pulls, the Wald-Wolfowitz runs test on the residual
+    signs (z and two-sided p) and the Fourier power of the pulls for
+    harmonics 1..n_fourier_harmonics, normalised to a mean of 2 for
+    uncorrelated unit pulls (less at the harmonic absorbed by the fit).
+    """
+    contents = np.asarray(contents, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    resid = contents[..., None, :] - predict(fit["scale"], fit["par"], templates)
+    out = {"res_mean": resid.mean(axis=-1), "res_std": resid.std(axis=-1),
+           "res_err_mean": np.mean(errors, axis=-1)}
+    if not diagnostics:
+        return out
+
+    pulls = np.zeros_like(resid)
+    np.divide(resid, errors[..., None, :], out=pulls, where=errors[..., None, :] > 0)
+    out["pull_mean"] = pulls.mean(axis=-1)
+    out["pull_std"] = pulls.std(axis=-1)
+
+    n = resid.shape[-1]
+    positive = resid > 0
+    runs = 1 + np.count_nonzero(positive[..., 1:] != positive[..., :-1], axis=-1)
+    n_pos = np.count_nonzero(positive, axis=-1)
+    n_neg = n - n_pos
+    runs_mean = 2.*n_pos*n_neg/n + 1.
+    runs_var = (runs_mean - 1.)*(runs_mean - 2.)/(n - 1.)
+    runs_z = np.zeros_like(runs_mean)
+    np.divide(runs - runs_mean, np.sqrt(np.maximum(runs_var, 0.)), out=runs_z, where=runs_var > 0)
+    out["runs_z"] = runs_z
+    out["runs_p"] = 2.*special.ndtr(-np.abs(runs_z))
+
+    k = np.arange(1, n_fourier_harmonics+1)[:, None]
+    x = bin_centres(edges)
+    cos_sum = np.einsum('...mn,kn->...mk', pulls, np.cos(k*x))
+    sin_sum = np.einsum('...mn,kn->...mk', pulls, np.sin(k*x))
+    out["fourier"] = 2.*(cos_sum**2 + sin_sum**2)/n
+    return out
+
+
+def fit_ensemble(edges, contents, errors, templates=None, chunk_size=10000, diagnostics=False,
+                 integrate=False):
+    """fit_models and residual_stats for an (n_toys, n_bins) ensemble.
+
+    Toys are processed in chunks to bound the (n_toys, n_models, n_bins)
+    residual array.
+    """
+    contents = np.atleast_2d(contents)
+    errors = np.atleast_2d(errors)
+    if templates is None:
+        templates = model_templates(edges, integrate=integrate)
+
+    out = collections.defaultdict(list)
+    for start in range(0, len(contents), chunk_size):
+        _contents = contents[start:start+chunk_size]
+        _errors = errors[start:start+chunk_size]
+        with timer.stage("fit"):
+            fit = fit_models(edges, _contents, _errors, templates)
+        with timer.stage("residuals"):
+            fit.update(residual_stats(edges, _contents, _errors, fit, templates, diagnostics))
+        del fit["scale"]
+        for key, value in fit.items():
+            out[key].append(value)
+    return {key: np.concatenate(value) for key, value in out.items()}
@@ -4,16 +4,34 @@
 
 
 import sys
-import ROOT
-ROOT.gROOT.SetBatch(True)
-import atlasplots as aplt
-aplt.set_atlas_style()
-
 import argparse
+import collections
+import fnmatch
+import glob
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import os
 import re
+import time
 import numpy as np
 
+from liv_models import models, get_joint_group, get_model_str, get_model_vector, load_extra_models
+import liv_fast_fit
+from liv_memory import memory
+from liv_profiling import profiled, timer
+from liv_hist_reader import LatencyReader, MultiHistReader, PackReader, get_reader, readers
+from liv_result_cache import ResultCache, file_fingerprint, make_key
+from liv_result_writer import (ensemble_rows, guess_format, joint_rows, open_writer, read_results, read_samples,
+                               result_columns, writers)
+from liv_online_stats import EnsembleStats, print_summary
+
+#ROOT and atlasplots are imported by import_root when the roofit code runs,
+#the numpy engine with the uproot, npz or pack input runs without them
+ROOT = None
+aplt = None
+
 coef_latex = {
         "d[u,X,Z]" : r"$d_{\it u}^{\it X,Z}$",
         "d[u,Y,Z]" : r"$d_{\it u}^{\it Y,Z}$",
@@ -29,225 +47,889 @@ coef_latex = {
         "c[d,X,Y]" : r"$c_{\it d}^{\it X,Y}$"
     }
 
-def get_model_str(coeff):
-    m_list = {"d[u,X,Z]" : "1+mu*(6.28069*cos(sday)-41.0569*sin(sday))",
-        "d[u,Y,Z]" : "1+mu*(41.0569*cos(sday)+6.28069*sin(sday))",
-        "d[u,X-Y,X-Y]" : "1+mu*(77.6067*cos(2*sday)+24.3128*sin(2*sday))",
-        "d[u,X,Y]" :  "1+mu*(-48.6256*cos(2*sday)+155.213*sin(2*sday))",
-        "c[u,X,Z]" : "1+mu*(8.084*cos(sday)-52.8451*sin(sday))",
-        "c[u,Y,Z]" : "1+mu*(52.8451*cos(sday)+8.084*sin(sday))",
-        "c[u,X-Y,X-Y]" : "1+mu*(99.8891*cos(2*sday)+31.2935*sin(2*sday))",
-        "c[u,X,Y]" : "1+mu*(-62.5869*cos(2*sday)+199.778*sin(2*sday))",
-        "c[d,X,Z]" : "1+mu*(0.181551*cos(sday)-1.1868*sin(sday))",
-        "c[d,Y,Z]" : "1+mu*(1.1868*cos(sday)+0.181551*sin(sday))",
-        "c[d,X-Y,X-Y]" : "1+mu*(2.24331*cos(2*sday)+0.702788*sin(2*sday))",
-        "c[d,X,Y]" : "1+mu*(-1.40558*cos(2*sday)+4.48662*sin(2*sday))"
-    }
 
-    return m_list[coeff]
+def get_toy_ID(iFile, id_regex):
+    try:
+        return re.search(id_regex, iFile).group(1)
+    except AttributeError:
+        # AAA, ZZZ not found in the original string
+        logging.error("can not extract toy ID!")
+        sys.exit()
+
+
+def import_root(plots=False):
+    """Import ROOT in batch mode, and atlasplots with the ATLAS style for plots."""
+    global ROOT, aplt
+    if ROOT is None:
+        import ROOT as _ROOT
+        _ROOT.gROOT.SetBatch(True)
+        ROOT = _ROOT
+    if plots and aplt is None:
+        import atlasplots as _aplt
+        _aplt.set_atlas_style()
+        aplt = _aplt
+    return ROOT
+
+
+def make_sday():
+    return ROOT.RooRealVar("sday", "#omega T", 0, 6.28319)
+
+
+class RooFitModels:
+    """The sidereal pdfs and their chi2, built once and reused for every toy.
     
+    Per toy only the dataset of the chi2 objects is swapped and mu is reset,
+    so formulas are compiled once per process instead of once per toy.
+    """
+    def __init__(self, sday=None, integrate_bins=False):
+        import_root()
+        self.sday = sday if sday is not None else make_sday()
+        self.integrate_bins = integrate_bins
+        self.chi2_options = [ROOT.RooFit.DataError(ROOT.RooAbsData.SumW2)]
+        if integrate_bins:
+            self.chi2_options.append(ROOT.RooFit.IntegrateBins(1e-6))
+        self.mus, self.pdfs, self.chi2s = {}, {}, {}
+        for model_str in models:
+            #parameter of interest
+            self.mus[model_str] = ROOT.RooRealVar("mu", "mu", 0, -0.5, 0.5)
+            self.pdfs[model_str] = ROOT.RooGenericPdf("sig", get_model_str(model_str),
+                                                      [self.sday, self.mus[model_str]])
+        self.data = None
+        self.h = None
+    
+    def set_data(self, h):
+        data = ROOT.RooDataHist("Data", "Data", [self.sday], Import=h)
+        self.sday.setBins(data.numEntries())
+        for model_str in models:
+            if model_str in self.chi2s:
+                #no clone, the chi2 points to data until the next toy
+                self.chi2s[model_str].setData(data, False)
+            else:
+                self.chi2s[model_str] = self.pdfs[model_str].createChi2(data, #ROOT.RooFit.Range("fullRange"),
+                                    *self.chi2_options)
+        #the previous dataset is released only after no chi2 uses it
+        self.data = data
+        return data
+    
+    def fit(self, model_str):
+        #same as chi2FitTo for weighted data, but reusing the chi2 object
+        mu = self.mus[model_str]
+        mu.setVal(0)
+        mu.setError(0)
+        with timer.stage("fit"):
+            minimizer = ROOT.RooMinimizer(self.chi2s[model_str])
+            minimizer.setPrintLevel(-1)
+            minimizer.migrad()
+            minimizer.hesse()
+        with timer.stage("chi2"):
+            chi2 = self.chi2s[model_str].getVal()
+        return mu.getValV(), mu.getError(), chi2
 
-def fit_to_data(coms=None):
+
+def arrays_to_hist(edges, contents, sumw2, h=None):
+    #refill h in place if it has the same binning, one TH1D per process
+    edges = np.asarray(edges, dtype=float)
+    if h is None or h.GetNbinsX() != len(contents) or \
+            any(h.GetXaxis().GetBinLowEdge(i+1) != edge for i, edge in enumerate(edges)):
+        h = ROOT.TH1D("h_fit", "h_fit", len(contents), edges)
+        h.SetDirectory(0)
+    else:
+        h.Reset()
+    for i, (content, error) in enumerate(zip(contents, np.sqrt(sumw2))):
+        h.SetBinContent(i+1, content)
+        h.SetBinError(i+1, error)
+    return h
+
+
+def fit_toy_roofit(hist, roofit_models, toy_ID, plot=False, ratio_plot=False, diagnostics=False):
+    edges, contents, sumw2 = hist
+    with timer.stage("build"):
+        h = roofit_models.h = arrays_to_hist(*hist, h=roofit_models.h)
+        sigData = roofit_models.set_data(h)
+    
+    MaxYvalue = h.GetBinContent(h.GetMaximumBin())
+    MinYvalue = h.GetBinContent(h.GetMinimumBin())
+    MaxDelta = max(abs(1-MaxYvalue)*2., abs(1-MinYvalue)*2.)
+    
+    #Create data
+    sday = roofit_models.sday
+        
+    #loop over models
+    results = []
+    for model_str in models:
+        par, err, chi2 = roofit_models.fit(model_str)
+        
+        #Save fit results.
+        degree_freedom = int(sigData.numEntries() - 1)
+        chi2_p0 = ROOT.Math.chisquared_cdf_c(chi2, degree_freedom)
+        
+        results += [par, err, chi2, chi2_p0]
+    
+    #residuals of all models from the bin arrays, no RooPlot needed
+    with timer.stage("residuals"):
+        fit = dict(zip(["par", "err", "chi2", "chi2_p0"], np.reshape(results, (1, len(models), 4)).transpose(2, 0, 1)))
+        templates = liv_fast_fit.model_templates(edges, integrate=roofit_models.integrate_bins)
+        fit.update(liv_fast_fit.residual_stats(edges, contents[None], np.sqrt(sumw2)[None],
+                                               dict(fit, scale=liv_fast_fit.expected_scale(edges, contents[None])),
+                                               templates, diagnostics))
+        residuals = ensemble_rows(fit)[1][0]
+    
+    if not plot:
+        return results, residuals
+    
+    plot_start = time.perf_counter()
+    import_root(plots=True)
+    for iModel, model_str in enumerate(models):
+        par, err = results[4*iModel], results[4*iModel+1]
+        res_mean, res_std = fit["res_mean"][0, iModel], fit["res_std"][0, iModel]
+        mu = roofit_models.mus[model_str]
+        model = roofit_models.pdfs[model_str]
+        
+        frame = sday.frame(Title=model_str);
+        sigData.plotOn(frame);
+        model.plotOn(frame);
+        frame.SetAxisRange(1-MaxDelta, 1+MaxDelta, "Y")
+        frame.GetYaxis().SetTitle("R")
+        frame.GetYaxis().SetTitleOffset(2)
+        hresid = frame.residHist()
+        residual  = sday.frame(Title="Residual Distribution")
+        residual.addPlotable(hresid, "P")
+        Nr = hresid.GetN()
+        
+        if ratio_plot:
+            TopC, (Upad, Lpad) = aplt.ratio_plot(name="ratio_plot", figsize=(800, 800), hspace=0.05)
+            Upad.cd()
+            frame.Draw()
+            frame.GetXaxis().SetLabelOffset(2)
+            Upad.add_margins(left=0.15)
+            # Add the ATLAS Label
+            aplt.atlas_label(text="Internal", loc="upper left")
+            #Upad.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
+            Upad.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
+            # Add extra space at top of plot to make room for labels
+            Upad.add_margins(top=0.15)
+            
+            Lpad.cd()
+            residual.GetYaxis().SetRangeUser(res_mean-3.5*res_std, res_mean+3.5*res_std,)
+            residual.GetYaxis().SetTitle("Data-Fit")
+            residual.GetYaxis().SetTitleOffset(2)
+            residual.Draw()
+            fConfidenceInterval1 = ROOT.TGraphErrors()
+            fConfidenceInterval2 = ROOT.TGraphErrors()
+            for i in range(Nr):
+                if i ==0:
+                    fConfidenceInterval1.AddPoint(0,res_mean)
+                    fConfidenceInterval2.AddPoint(0,res_mean)
+                elif i == Nr-1:
+                    fConfidenceInterval1.AddPoint(6.28319,res_mean)
+                    fConfidenceInterval2.AddPoint(6.28319,res_mean)
+                else:
+                    fConfidenceInterval1.AddPoint(hresid.GetPointX(i),res_mean)
+                    fConfidenceInterval2.AddPoint(hresid.GetPointX(i),res_mean)
+                fConfidenceInterval1.SetPointError(i, 0.0, res_std)
+                fConfidenceInterval2.SetPointError(i, 0.0, 2*res_std)
+            
+            fConfidenceInterval2.GetXaxis().SetRangeUser(0,6.28319)
+            fConfidenceInterval1.GetXaxis().SetRangeUser(0,6.28319)
+            fConfidenceInterval2.SetFillColor(ROOT.kGreen);
+            fConfidenceInterval1.SetFillColor(ROOT.kYellow);
+            fConfidenceInterval2.Draw("I3")
+            fConfidenceInterval1.Draw("3")
+            residual.Draw("same")
+            
+            line = ROOT.TLine(0, 0, 6.28319, 0)
+            Lpad.plot(line)
+            Lpad.add_margins(left=0.15)
+            TopC.savefig(("plots/fit_results_"+model_str+"_"+toy_ID+"_residual_12func.pdf"))
+        
+        fitDataFig, fitData = aplt.subplots(1, 1, name="fitplot", figsize=(800, 600))
+        fitData.cd()
+        frame.Draw()
+        # Add the ATLAS Label
+        aplt.atlas_label(text="Internal", loc="upper left")
+        #fitData.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
+        fitData.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
+        fitDataFig.savefig(("plots/fit_results_"+model_str+"_"+toy_ID+"_12func.pdf"))
+        
+        #create profile of mu
+        print("Sday: ", sday.getValV())
+        Scanfig, Scan = aplt.subplots(1, 1, name="Scan", figsize=(800, 600))
+        Scan.cd()
+        frame1 = mu.frame(Range=(par-err*3, par+err*3), Title=f"{model_str}")
+        #the chi2 is a parabola in mu, the profile needs no minimisation
+        mu_grid, dchi2, _ = liv_fast_fit.profile_scan(par, err)
+        profile_mu = ROOT.TGraph(len(mu_grid), mu_grid, dchi2)
+        profile_mu.SetLineColor(ROOT.kRed)
+        profile_mu.SetLineWidth(3)
+        frame1.addObject(profile_mu, "L")
+        #the frame owns and deletes the graph
+        ROOT.SetOwnership(profile_mu, False)
+        frame1.SetMinimum(0)
+        frame1.SetMaximum(dchi2.max())
+        frame1.Draw()
+        Scan.add_margins(left=0.15)
+        #Scan.add_margins(top=0.15)
+        # Add the ATLAS Label
+        aplt.atlas_label(text="Internal", loc="upper left")
+        #Scan.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
+        Scan.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
+        Scanfig.savefig(("plots/profile_chi2PDF_"+model_str+"_"+toy_ID+"_12func.pdf"))
+        #print(f"chi2_pdf: {chi2_pdf.getVal()}")
+        
+        #release the canvases, then the frames, nothing of this model is kept
+        #until the next toy. Frames come from ROOT factories and are only
+        #deleted with their proxy once python owns them
+        if ratio_plot:
+            del TopC, Upad, Lpad, fConfidenceInterval1, fConfidenceInterval2, line
+        del fitDataFig, fitData, Scanfig, Scan
+        for plotted in (frame, residual, frame1):
+            ROOT.SetOwnership(plotted, True)
+        del frame, residual, frame1, hresid, profile_mu
+
+    timer.add("plot", time.perf_counter() - plot_start)
+    return results, residuals
+
+
+def interval_row(results):
+    #low/high crossing of dchi2=1 and dchi2=4 for every model
+    results = np.reshape(results, (len(models), 4))
+    intervals = liv_fast_fit.profile_intervals(results[:, 0], results[:, 1])
+    return np.stack(intervals[1] + intervals[2], axis=-1).ravel().tolist()
+
+
+def fit_toy_numpy(edges, contents, sumw2, diagnostics=False, integrate=False):
+    results, residuals = ensemble_rows(liv_fast_fit.fit_ensemble(edges, contents, np.sqrt(sumw2),
+                                                                 diagnostics=diagnostics, integrate=integrate))
+    return results[0], residuals[0]
+
+
+def load_ensemble(tasks, reader, args):
+    #read all histograms into (n_toys, n_bins) arrays
+    try:
+        edges, contents, sumw2 = reader.read_all([key for key, _ in tasks], args.prefetch, args.io_threads)
+    except ValueError as e:
+        logging.error(f"{e}, batch mode needs a common binning!")
+        sys.exit()
+    return [toy_ID for _, toy_ID in tasks], edges, contents, np.sqrt(sumw2)
+
+
+def validate_engines(tasks, roofit_models, reader, args):
+    #compare the NumPy engine with RooFit on toys spread over the list
+    picks = np.unique(np.linspace(0, len(tasks)-1, min(args.validate, len(tasks))).astype(int))
+    delta = []
+    for idx in picks:
+        key, toy_ID = tasks[idx]
+        hist = reader.read_retry(key)
+        roofit, _ = fit_toy_roofit(hist, roofit_models, toy_ID)
+        fast, _ = fit_toy_numpy(*hist, integrate=args.integrate_bins)
+        roofit = np.reshape(roofit, (len(models), 4))
+        fast = np.reshape(fast, (len(models), 4))
+        delta.append(np.abs(fast - roofit) / np.array([roofit[:, 1], roofit[:, 1], np.ones(len(models)), np.ones(len(models))]).T)
+    delta = np.max(delta, axis=0)
+    
+    print(f"validated {len(picks)} toys, max deviation numpy vs roofit")
+    print(f"{'model':14} {'dpar/err':>10} {'derr/err':>10} {'dchi2':>10} {'dchi2_p0':>10}")
+    for model_str, d in zip(models, delta):
+        print(f"{model_str:14} {d[0]:10.2E} {d[1]:10.2E} {d[2]:10.2E} {d[3]:10.2E}")
+    return delta
+
+
+def save_plot_artefacts(artefact_dir, toy_ID, hist, results, integrate=False):
+    #everything render_fit_plots.py needs, so plotting stays out of the fit loop
+    edges, contents, sumw2 = hist
+    errors = np.sqrt(sumw2)
+    results = np.reshape(results, (len(models), 4))
+    par, err = results[:, 0], results[:, 1]
+    templates = liv_fast_fit.model_templates(edges, integrate=integrate)
+    scale = liv_fast_fit.expected_scale(edges, contents)
+    prediction = liv_fast_fit.predict(scale, par, templates)
+    mu_grid, _, profile = liv_fast_fit.profile_scan(par, err, results[:, 2], n_points=61)
+    np.savez(os.path.join(artefact_dir, f"toy_{toy_ID}.npz"), toy_ID=toy_ID, models=np.array(models),
+             vectors=np.array([get_model_vector(m) for m in models]),
+             edges=edges, contents=contents, errors=errors, scale=scale,
+             par=par, err=err, chi2=results[:, 2], chi2_p0=results[:, 3],
+             prediction=prediction, residuals=contents - prediction,
+             mu_grid=mu_grid, profile=profile)
+
+
+def fit_hist(hist, toy_ID, roofit_models, args, tag=None):
+    plot = int(toy_ID) in args.plot
+    #plots of several histograms of a toy are told apart by the tag
+    name = f"{toy_ID}_{tag}" if tag else toy_ID
+    if args.engine == "numpy":
+        if plot and not args.defer_plots:
+            logging.warning(f"no plots for toy {toy_ID}, the numpy engine only supports --defer_plots")
+        results, residuals = fit_toy_numpy(*hist, diagnostics=args.residual_diagnostics,
+                                           integrate=args.integrate_bins)
+    else:
+        results, residuals = fit_toy_roofit(hist, roofit_models, name, plot=plot and not args.defer_plots,
+                                            ratio_plot=args.ratio_plot, diagnostics=args.residual_diagnostics)
+    if plot and args.defer_plots:
+        with timer.stage("plot"):
+            save_plot_artefacts(args.defer_plots, name, hist, results, args.integrate_bins)
+    return toy_ID, results, residuals
+
+
+_worker_state = None
+
+def _init_worker(args):
+    global _worker_state
+    if args.extra_models:
+        load_extra_models(args.extra_models)
+    roofit_models = RooFitModels(integrate_bins=args.integrate_bins) if args.engine == "roofit" else None
+    timer.enable(bool(args.profile))
+    _worker_state = (roofit_models, make_reader(args), args)
+
+
+def _fit_file_worker(tasks):
+    #all tasks of one file, so it is opened once per worker. Stage times
+    #travel back with the results, the main process books them
+    roofit_models, reader, args = _worker_state
+    rows = [fit_hist(reader.read_retry(key), toy_ID, roofit_models, args, task_tag(key)) for key, toy_ID in tasks]
+    return rows, timer.pop()
+
+
+def make_reader(args):
+    if args.input_pack:
+        return PackReader(args.input_pack)
+    reader = get_reader(args.reader, args.h_name[0])
+    if args.simulate_latency or args.simulate_failures:
+        reader = LatencyReader(reader, args.simulate_latency, args.simulate_failures)
+    if multi_hist(args):
+        reader = MultiHistReader(reader, args.h_name)
+    reader.retries = args.read_retries
+    reader.retry_wait = args.retry_wait
+    return reader
+
+
+def report_input(reader):
+    #how well reading overlapped the fits, only known when the main process reads
+    if reader.n_reads == 0:
+        return
+    print(f"read {reader.n_reads} histograms, {reader.n_retries} retries, fitter starved "
+          f"{reader.starved_s:.2f} s of {reader.wall_s:.2f} s ({reader.starved_fraction():.1%})")
+
+
+def iter_tasks(reader, args):
+    #(reader key, toy_ID) of every toy, file paths or rows of a pack,
+    #the list file is read line by line
+    if args.input_pack:
+        yield from enumerate(reader.toy_IDs)
+        return
+    
+    with open(args.input_list, 'r') as toy_files:
+        for iFile in toy_files:
+            if iFile.strip():
+                yield iFile.strip(), get_toy_ID(iFile.strip(), args.id_regex)
+
+
+def get_tasks(reader, args):
+    #read list of root files
+    return list(iter_tasks(reader, args))
+
+
+def count_tasks(reader, args):
+    if args.input_pack:
+        return len(reader.toy_IDs)
+    with open(args.input_list, 'r') as toy_files:
+        return sum(1 for iFile in toy_files if iFile.strip())
+
+
+def chunk_range(n_tasks, chunk):
+    #contiguous slice i of N, so merged shards keep the input order
+    try:
+        i, n = (int(x) for x in chunk.split('/'))
+    except ValueError:
+        logging.error(f"can not parse chunk {chunk}, expected i/N!")
+        sys.exit()
+    if n < 1 or not 0 <= i < n:
+        logging.error(f"chunk {chunk} out of range, i has to be in [0, N)!")
+        sys.exit()
+    return n_tasks*i//n, n_tasks*(i+1)//n
+
+
+def multi_hist(args):
+    return len(args.h_name) > 1 or bool(args.configs)
+
+
+def resolve_h_names(reader, path, patterns):
+    #histogram names, glob patterns are matched against the first file
+    names = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matched = fnmatch.filter(reader.list_hists(path), pattern)
+            if not matched:
+                logging.error(f"no histogram matching {pattern} in {path}!")
+                sys.exit()
+        else:
+            matched = [pattern]
+        names += [name for name in matched if name not in names]
+    return names
+
+
+def make_tag(config, h_name, args):
+    #output suffix of a histogram, safe in file names
+    tag = f"{config}_{h_name}" if args.configs else h_name
+    return re.sub(r'[^\w.,+\-\[\]]', '_', tag)
+
+
+def expand_tasks(tasks, args):
+    #one task (path, h_name, tag) per histogram and configuration of every
+    #file, the histograms of a file are consecutive. The files of a
+    #configuration are the listed ones with the first configuration replaced
+    for key, toy_ID in tasks:
+        if args.configs and args.configs[0] not in key:
+            logging.error(f"{key} does not contain configuration {args.configs[0]}!")
+            sys.exit()
+        for config in args.configs or [None]:
+            path = key.replace(args.configs[0], config) if config else key
+            for h_name in args.h_name:
+                yield (path, h_name, make_tag(config, h_name, args)), toy_ID
+
+
+def task_tag(key):
+    return key[2] if isinstance(key, tuple) else None
+
+
+def key_path(key):
+    return key[0] if isinstance(key, tuple) else key
+
+
+def get_chunk(tasks, chunk):
+    return tasks[slice(*chunk_range(len(tasks), chunk))]
+
+
+def iter_chunks(tasks, size):
+    #lists of up to size tasks from any iterable
+    tasks = iter(tasks)
+    while True:
+        chunk = list(itertools.islice(tasks, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def cache_key(key, reader, args):
+    if isinstance(reader, PackReader):
+        _, contents, sumw2 = reader.read(key)
+        source = hashlib.sha256(contents.tobytes()+sumw2.tobytes()).hexdigest()
+    else:
+        source = file_fingerprint(key_path(key), content=args.cache_hash == "content")
+    h_name = key[1] if isinstance(key, tuple) else reader.h_name
+    #batch and single toy numpy fits are identical, --batch is not part of the key
+    return make_key(source, h_name, [get_model_str(m) for m in models], args.engine,
+                    args.residual_diagnostics, args.integrate_bins)
+
+
+def fit_rows(tasks, roofit_models, reader, args):
+    #yield toy_ID, fit results and residual stats in input order,
+    #answering toys from the result cache where possible
+    if not args.cache:
+        yield from fit_tasks(tasks, roofit_models, reader, args)
+        return
+    
+    cache = ResultCache(args.cache, max_mb=args.cache_size)
+    n_toys = 0
+    try:
+        #lookups and fits per --batch_size toys, so long lists are not held in memory
+        for batch in iter_chunks(tasks, args.batch_size):
+            keys, cached = [], []
+            for key, toy_ID in batch:
+                with timer.stage("cache"):
+                    keys.append(cache_key(key, reader, args))
+                    #plots are only made while fitting
+                    plotted = int(toy_ID) in args.plot and (args.engine == "roofit" or args.defer_plots)
+                    cached.append(None if plotted else cache.get(keys[-1]))
+            n_toys += len(batch)
+            
+            fitted = fit_tasks([task for task, row in zip(batch, cached) if row is None], roofit_models, reader, args)
+            for (_, toy_ID), key, row in zip(batch, keys, cached):
+                if row is None:
+                    _, results, residuals = next(fitted)
+                    with timer.stage("cache"):
+                        cache.put(key, [results, residuals])
+                    yield toy_ID, results, residuals
+                else:
+                    yield toy_ID, row[0], row[1]
+    finally:
+        print(f"result cache: {cache.hits} of {n_toys} toys cached")
+        cache.close()
+
+
+def fit_tasks(tasks, roofit_models, reader, args):
+    #tasks may be any iterable, it is consumed lazily
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return
+    tasks = itertools.chain([first], tasks)
+    
+    if args.batch:
+        #one ensemble fit per --batch_size toys bounds the arrays
+        for batch in iter_chunks(tasks, args.batch_size):
+            toy_IDs, edges, contents, errors = load_ensemble(batch, reader, args)
+            results, residuals = ensemble_rows(liv_fast_fit.fit_ensemble(edges, contents, errors,
+                                                                         diagnostics=args.residual_diagnostics,
+                                                                         integrate=args.integrate_bins))
+            if args.defer_plots:
+                for i, ((key, _), toy_ID) in enumerate(zip(batch, toy_IDs)):
+                    if int(toy_ID) in args.plot:
+                        name = f"{toy_ID}_{task_tag(key)}" if task_tag(key) else toy_ID
+                        save_plot_artefacts(args.defer_plots, name, (edges, contents[i], errors[i]**2), results[i],
+                                            args.integrate_bins)
+            yield from zip(toy_IDs, results, residuals)
+        return
+    
+    if args.jobs > 1:
+        #spawn gives every worker its own ROOT state. The tasks of a file go
+        #to one worker, at most 4 files per worker are in flight, and none
+        #are submitted above the memory ceiling until the results in flight
+        #are written
+        with multiprocessing.get_context("spawn").Pool(args.jobs, initializer=_init_worker, initargs=(args,),
+                                                       maxtasksperchild=args.max_tasks_per_worker) as pool:
+            pending = collections.deque()
+            for _, file_tasks in itertools.groupby(tasks, key=lambda task: key_path(task[0])):
+                pending.append(pool.apply_async(_fit_file_worker, (list(file_tasks),)))
+                while len(pending) > 4*args.jobs or (pending and memory.over()):
+                    rows, stages = pending.popleft().get()
+                    timer.merge(stages)
+                    yield from rows
+            while pending:
+                rows, stages = pending.popleft().get()
+                timer.merge(stages)
+                yield from rows
+        return
+    
+    tasks, keys = itertools.tee(tasks)
+    hists = reader.iter_read((key for key, _ in keys), args.prefetch, args.io_threads)
+    try:
+        for (key, toy_ID), hist in zip(tasks, hists):
+            yield fit_hist(hist, toy_ID, roofit_models, args, task_tag(key))
+    finally:
+        #zip stops on the tasks, iter_read books its wall time when closed
+        hists.close()
+
+
+def fit_joint_tasks(tasks, groups, reader, args, chunk_size=10000):
+    #simultaneous fit of every group of models, read and solved in chunks of toys
+    for batch in iter_chunks(tasks, chunk_size):
+        toy_IDs, edges, contents, errors = load_ensemble(batch, reader, args)
+        rows = []
+        for group in groups.values():
+            templates = liv_fast_fit.model_templates(edges, group, args.integrate_bins)
+            with timer.stage("fit"):
+                rows.append(joint_rows(liv_fast_fit.fit_joint(edges, contents, errors, templates)))
+        yield from zip(toy_IDs, np.concatenate(rows, axis=1).tolist())
+
+
+def make_online_stats(args, writer):
+    #a resumed run re-accumulates the toys already in the output, the last
+    #dump may miss the toys written after it
+    online = EnsembleStats(models, args.truth)
+    if writer.done:
+        columns = result_columns()[1:1+4*len(models)]
+        for row in read_results(writer.path, columns=columns).to_numpy():
+            online.add(row)
+        online.flush()
+    return online
+
+
+def tagged_path(path, tag):
+    #<stem>_<tag><ext>, the path itself without tag
+    if path is None or tag is None:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_{tag}{ext}"
+
+
+class FitOutput:
+    """Result file, interval file and online statistics of one histogram."""
+    def __init__(self, args, groups, tag=None):
+        self.args = args
+        self.tag = tag
+        output = tagged_path(args.output, tag)
+        self.writer = open_writer(args.output_format or guess_format(args.output), output,
+                                  tagged_path(args.residual_output, tag), args.resume,
+                                  args.residual_diagnostics, groups if args.joint else None)
+        if self.writer.done:
+            logging.info(f"resuming {output}, {len(self.writer.done)} toys already written")
+        
+        #per model rows only, joint fits write just the result file
+        self.interval_file = None
+        if args.interval_output and not args.joint:
+            interval_path = tagged_path(args.interval_output, tag)
+            rows, kept = [], set()
+            if args.resume and os.path.exists(interval_path):
+                #the intervals are written every toy and the results in batches,
+                #keep one row of each toy whose results survived a crash
+                with open(interval_path, 'r') as _f:
+                    for line in _f:
+                        toy_ID = line.split(' ', 1)[0]
+                        if line.endswith('\n') and toy_ID in self.writer.done and toy_ID not in kept:
+                            rows.append(line)
+                            kept.add(toy_ID)
+            #and recompute the rows lost from the write buffer
+            missing = [toy_ID for toy_ID in self.writer.done if toy_ID not in kept]
+            if missing:
+                columns = result_columns()[1:1+4*len(models)]
+                samples = read_samples(self.writer.path, missing, columns=columns).to_numpy().tolist()
+                for toy_ID, results in zip(missing, samples):
+                    rows.append(' '.join(str(x) for x in [toy_ID]+interval_row(results))+' \n')
+            self.interval_file = open(interval_path, 'w')
+            self.interval_file.writelines(rows)
+        self.online = make_online_stats(args, self.writer) if args.online_stats and not args.joint else None
+        self.online_path = tagged_path(args.online_stats, tag)
+        self.converged = False
+    
+    def write(self, toy_ID, results, residuals=()):
+        with timer.stage("write"):
+            self.writer.write(toy_ID, results, residuals)
+            if self.interval_file:
+                self.interval_file.write(' '.join(str(x) for x in [toy_ID]+interval_row(results))+' \n')
+        online = self.online
+        if online:
+            online.add(results)
+            if online.n % self.args.online_every == 0:
+                online.dump(self.online_path)
+                if self.args.stop_when_converged and online.converged(self.args.stop_when_converged):
+                    self.converged = True
+    
+    def close(self):
+        with timer.stage("write"):
+            self.writer.close()
+        if self.interval_file:
+            self.interval_file.close()
+        if self.online:
+            self.online.dump(self.online_path)
+            if self.tag:
+                print(f"{self.tag}:")
+            print_summary(self.online)
+
+
+def run_fit(args):
+    #common
+    if args.extra_models:
+        load_extra_models(args.extra_models)
+    groups = {}
+    for spec in args.joint or []:
+        try:
+            groups[spec] = get_joint_group(spec)
+        except ValueError as e:
+            logging.error(f"{e}!")
+            sys.exit()
+    roofit_models = None
+    if (args.engine == "roofit" and not args.joint) or args.validate > 0:
+        roofit_models = RooFitModels(integrate_bins=args.integrate_bins)
+    reader = make_reader(args)
+    memory.configure(args.max_rss_mb, args.memory_every, args.memory_log)
+    
+    if args.stream:
+        #the list is read while fitting, only --batch_size toys are held at once
+        tasks = iter_tasks(reader, args)
+        if args.chunk:
+            tasks = itertools.islice(tasks, *chunk_range(count_tasks(reader, args), args.chunk))
+        first = next(tasks, None)
+        tasks = [] if first is None else itertools.chain([first], tasks)
+    else:
+        tasks = get_tasks(reader, args)
+        
+        if args.chunk:
+            tasks = get_chunk(tasks, args.chunk)
+    
+    if not tasks: 
+        logging.error("root list is empty!")
+        sys.exit()
+    
+    if multi_hist(args) or any(glob.has_magic(h_name) for h_name in args.h_name):
+        if args.input_pack:
+            logging.error("a pack holds one histogram, use --input_list for several --h_name or --configs!")
+            sys.exit()
+        tasks = iter(tasks)
+        first = next(tasks)
+        tasks = itertools.chain([first], tasks)
+        args.h_name = resolve_h_names(reader, first[0], args.h_name)
+        if multi_hist(args):
+            logging.info(f"fitting histograms {args.h_name} of configurations {args.configs or ['as listed']}")
+            tasks = expand_tasks(tasks, args)
+        reader = make_reader(args)
+    if multi_hist(args):
+        tags = [make_tag(config, h_name, args) for config in args.configs or [None] for h_name in args.h_name]
+    else:
+        tags = [None]
+    
+    if args.defer_plots:
+        os.makedirs(args.defer_plots, exist_ok=True)
+    
+    if args.validate > 0:
+        validate_engines(list(tasks), roofit_models, reader, args)
+        return
+    
+    #create output files, one set per histogram
+    try:
+        outputs = {tag: FitOutput(args, groups, tag) for tag in tags}
+    except ValueError as e:
+        logging.error(f"{e}!")
+        sys.exit()
+    if any(output.writer.done for output in outputs.values()):
+        tasks = (task for task in tasks if str(task[1]) not in outputs[task_tag(task[0])].writer.done)
+    
+    #the fitted rows come in task order, the tee gives the tag of every row
+    tasks, tagged = itertools.tee(tasks)
+    if args.joint:
+        rows = fit_joint_tasks(tasks, groups, reader, args, args.batch_size)
+    else:
+        rows = fit_rows(tasks, roofit_models, reader, args)
+    try:
+        for (key, _), (toy_ID, *row) in zip(tagged, rows):
+            output = outputs[task_tag(key)]
+            output.write(toy_ID, *row)
+            timer.end_toy(toy_ID)
+            memory.end_toy()
+            if output.converged and all(o.converged for o in outputs.values()):
+                print(f"bias and coverage converged after {output.online.n} toys, stopping")
+                break
+    finally:
+        #the readers finish their input statistics when closed
+        rows.close()
+    
+    for output in outputs.values():
+        output.close()
+    report_input(reader)
+
+
+def make_parser():
     argparser = argparse.ArgumentParser(description='fit double ratio')
-    argparser.add_argument('--input_list',required=True,
-                           type=str, help='text file, contains list of root files')
+    inputs = argparser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input_list',
+                        type=str, help='text file, contains list of root files')
+    inputs.add_argument('--input_pack',
+                        type=str, help='histogram pack directory written by pack_hists.py')
     argparser.add_argument('--output',required=True,
                            type=str, help='output file name')
     
-    argparser.add_argument('--id_regex', required=True, type=str,
+    argparser.add_argument('--id_regex', type=str,
                            help='regex <_seed(.+?).root> of root file name to find toy ID,')
-    argparser.add_argument('--h_name', default="h_generated", help='histogram name')
-    argparser.add_argument('--plot', type=int, nargs='+', default=1, help='sample ID for plot')
+    argparser.add_argument('--h_name', default=["h_generated"], nargs='+',
+                           help='histogram names or glob patterns, with several every file is opened once and '
+                           'each histogram is written to --output with the name as suffix')
+    argparser.add_argument('--configs', default=None, nargs='+', type=str,
+                           help='configurations like sig_config_0 sig_config_1, --input_list lists the files of '
+                           'the first one and the others are the same paths with it replaced, outputs get '
+                           '<config>_<h_name> suffixes')
+    argparser.add_argument('--plot', type=int, nargs='+', default=[], help='sample IDs to plot, none by default')
     argparser.add_argument('--ratio_plot', action='store_true', default=False, help='sample ID for plot')
-    
+    argparser.add_argument('--defer_plots', default=None, type=str,
+                           help='only store plot inputs of --plot toys in this directory, render with render_fit_plots.py')
+    argparser.add_argument('--engine', default=None, choices=["roofit", "numpy"],
+                           help='fit with RooFit/Minuit or with the closed-form NumPy chi2, '
+                           'roofit by default and numpy with --batch')
+    argparser.add_argument('--integrate_bins', action='store_true', default=False,
+                           help='compare data with the model averaged over each bin instead of at the bin centre')
+    argparser.add_argument('--extra_models', default=None, type=str,
+                           help='json file {name: [cos, sin, cos2, sin2]} of models fitted after the 12 default ones')
+    argparser.add_argument('--joint', default=None, nargs='+', type=str,
+                           help='fit groups of models simultaneously instead of one by one, each group a preset '
+                           '(d[u], c[u], c[d] or a harmonic pair like d[u]h1) or model names joined by +, '
+                           'writes par, err, chi2 and covariance of every group to a csv/arrow --output')
+    argparser.add_argument('--validate', type=int, default=0,
+                           help='compare numpy and roofit engines on this many toys and exit')
+    argparser.add_argument('--batch', action='store_true', default=False,
+                           help='fit all toys at once with the numpy engine, needs a common sday binning')
+    argparser.add_argument('--reader', default="root", choices=sorted(readers),
+                           help='histogram reader, uproot and npz run without ROOT')
+    argparser.add_argument('--prefetch', type=int, default=0,
+                           help='number of files read ahead on background threads')
+    argparser.add_argument('--io_threads', type=int, default=None,
+                           help='threads reading ahead, --prefetch by default')
+    argparser.add_argument('--read_retries', type=int, default=0,
+                           help='retries of a file that fails to open, e.g. on EOS')
+    argparser.add_argument('--retry_wait', type=float, default=1.,
+                           help='seconds before the first retry, doubled for every further one')
+    argparser.add_argument('--simulate_latency', type=float, default=0.,
+                           help='testing: mean latency in s added to every read of a local file')
+    argparser.add_argument('--simulate_failures', type=float, default=0.,
+                           help='testing: fraction of reads failing like a transient open error')
+    argparser.add_argument('--interval_output', default=None,
+                           type=str, help='output file name of 1 and 2 sigma intervals of mu')
+    argparser.add_argument('--residual_diagnostics', action='store_true', default=False,
+                           help='also write residual pulls, runs test and Fourier power per model')
+    argparser.add_argument('--output_format', default=None, choices=sorted(writers),
+                           help='txt (legacy, with residual file), csv or arrow, default from the --output extension')
+    argparser.add_argument('--resume', action='store_true', default=False,
+                           help='keep toys already in a csv/arrow --output and only fit the rest')
+    argparser.add_argument('--residual_output', default="residual_12func.txt",
+                           type=str, help='output file name of residual statistics, txt format only')
+    argparser.add_argument('--cache', default=None, type=str,
+                           help='sqlite file caching fit results, reruns only fit new or changed toys')
+    argparser.add_argument('--cache_size', type=float, default=512, help='cache size limit in MB')
+    argparser.add_argument('--cache_hash', default="stat", choices=["stat", "content"],
+                           help='identify input files by path, mtime and size or by a content hash')
+    argparser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    argparser.add_argument('--max_tasks_per_worker', type=int, default=None,
+                           help='replace a worker process after this many files, returns memory ROOT keeps')
+    argparser.add_argument('--stream', action='store_true', default=False,
+                           help='read --input_list while fitting instead of up front, for very long lists')
+    argparser.add_argument('--batch_size', type=int, default=10000,
+                           help='toys read and fitted at once with --batch, --joint or --cache')
+    argparser.add_argument('--max_rss_mb', type=float, default=None,
+                           help='soft memory ceiling, read-ahead and worker submission pause above it')
+    argparser.add_argument('--memory_every', type=int, default=None,
+                           help='toys between RSS reports, 1000 with --max_rss_mb or --memory_log')
+    argparser.add_argument('--memory_log', default=None, type=str,
+                           help='csv of the current and peak RSS every --memory_every toys')
+    argparser.add_argument('--chunk', default=None, type=str,
+                           help='only fit chunk i/N (i from 0) of the input list, merge with merge_fit_results.py')
+    argparser.add_argument('--online_stats', default=None, type=str,
+                           help='json file of ensemble statistics updated while fitting, merge shards with liv_online_stats.py')
+    argparser.add_argument('--online_every', type=int, default=1000, help='toys between dumps of --online_stats')
+    argparser.add_argument('--truth', type=float, default=0., help='true mu of every model for pulls and coverage')
+    argparser.add_argument('--stop_when_converged', type=float, default=None,
+                           help='stop once the error of the pull mean and of the 1 sigma coverage is below this '
+                           'for every model, checked at every --online_stats dump')
+    argparser.add_argument('--profile', default=None, type=str,
+                           help='time every stage per toy, write <PROFILE>_stages.csv and <PROFILE>_summary.json')
+    argparser.add_argument('--cprofile', action='store_true', default=False,
+                           help='also run under cProfile, stats in <PROFILE>.prof')
+    return argparser
+
+
+def fit_to_data(coms=None):
+    argparser = make_parser()
     if coms:
         args = argparser.parse_args(coms)
     else:
         args = argparser.parse_args()
     
-    #common
-    sday = ROOT.RooRealVar("sday", "#omega T", 0, 6.28319)
-    
-    #create output file
-    target_file = open(args.output, 'w')
-    #create output file
-    residual_file = open("residual_12func.txt", 'w')
+    if args.input_list and not args.id_regex:
+        logging.error("--id_regex is required with --input_list!")
+        sys.exit()
     
-    #read list of root files
-    toy_files = open(args.input_list, 'r')
-    root_list = toy_files.readlines()
-    toy_files.close()
+    #batch fits are numpy fits of the whole ensemble
+    if args.batch and args.engine == "roofit":
+        logging.error("--batch only works with --engine numpy!")
+        sys.exit()
+    if args.engine is None:
+        args.engine = "numpy" if args.batch else "roofit"
+    if args.batch and args.plot and not args.defer_plots:
+        logging.warning(f"no plots for toys {args.plot}, --batch only supports --defer_plots")
     
-    if len(root_list)<1: 
-        logging.error("root list is empty!")
+    #convergence is checked on the --online_stats dumps, which --joint does not write
+    if args.stop_when_converged and (not args.online_stats or args.joint):
+        logging.error("--stop_when_converged needs --online_stats and does not work with --joint!")
         sys.exit()
-        
-    for iFile in root_list:
-        iFile=iFile.strip()
-        
-        #get toy_ID
+    
+    uses_root = (args.engine == "roofit" and not args.joint) or args.validate > 0 or (args.reader == "root" and not args.input_pack)
+    if uses_root:
         try:
-            toy_ID = re.search(args.id_regex, iFile).group(1)
-        except AttributeError:
-            # AAA, ZZZ not found in the original string
-            logging.error("can not extract toy ID!")
+            import_root()
+        except ImportError:
+            logging.error("ROOT is not available, use --engine numpy with the uproot, npz or pack input!")
             sys.exit()
-        
-        #store toy ID
-        target_file.write(str(toy_ID)+' ')
-        residual_file.write(str(toy_ID)+' ')
-        
-        #open the root file and get hist
-        _f = ROOT.TFile.Open(iFile, 'r')
-        h = _f.Get(args.h_name)
-        h.SetDirectory(0)
-        _f.Close()
-        
-        MaxYvalue = h.GetBinContent(h.GetMaximumBin())
-        MinYvalue = h.GetBinContent(h.GetMinimumBin())
-        MaxDelta = max(abs(1-MaxYvalue)*2., abs(1-MinYvalue)*2.)
-        
-        #Create data
-        sigData = ROOT.RooDataHist("Data", "Data", [sday], Import=h)        
-        sday.setBins(sigData.numEntries())
-            
-        #loop over models
-        models = ["d[u,X,Z]", "d[u,Y,Z]", "d[u,X-Y,X-Y]", "d[u,X,Y]",
-                 "c[u,X,Z]", "c[u,Y,Z]", "c[u,X-Y,X-Y]", "c[u,X,Y]",
-                 "c[d,X,Z]", "c[d,Y,Z]", "c[d,X-Y,X-Y]", "c[d,X,Y]"]
-        for model_str in models:
-            #parameter of interest
-            mu = ROOT.RooRealVar("mu", "mu", 0, -0.5, 0.5);
-            model = ROOT.RooGenericPdf("sig", get_model_str(model_str),[sday, mu])
-            
-            model.chi2FitTo(sigData)
-                        #ROOT.RooFit.RecoverFromUndefinedRegions(1.)
-                        #ROOT.RooFit.IntegrateBins(0.)
-                      
-            
-            par = mu.getValV()
-            err = mu.getError()
-            
-            
-            #Save fit results.
-            chi2 = model.createChi2(sigData, #ROOT.RooFit.Range("fullRange"),
-                                    ROOT.RooFit.DataError(ROOT.RooAbsData.SumW2)).getVal()
-            degree_freedom = int(sigData.numEntries() - 1)
-            chi2_p0 = ROOT.Math.chisquared_cdf_c(chi2, degree_freedom)
-            
-            #Store results to a text file 
-            target_file.write(str(par)+' ')
-            target_file.write(str(err)+' ')
-            target_file.write(str(chi2)+' ')
-            target_file.write(str(chi2_p0)+' ')
-            
-            frame = sday.frame(Title=model_str);
-            sigData.plotOn(frame);
-            model.plotOn(frame);
-            frame.SetAxisRange(1-MaxDelta, 1+MaxDelta, "Y")
-            frame.GetYaxis().SetTitle("R")
-            frame.GetYaxis().SetTitleOffset(2)
-            hresid = frame.residHist()
-            residual  = sday.frame(Title="Residual Distribution")
-            residual.addPlotable(hresid, "P")
-            Nr = hresid.GetN()
-            
-            res_points = []
-            mean_stats = []
-            for i in range(Nr):
-                res_points.append(  hresid.GetPointY(i))
-                mean_stats.append( hresid. GetErrorY(i) )
-                
-            res_mean, res_std = np.mean(res_points), np.std(res_points)
-            mean_stats = np.mean(mean_stats)
-            residual_file.write(str(res_mean)+' ')
-            residual_file.write(str(res_std)+' ')
-            if model_str == models[-1]:
-                residual_file.write(str(mean_stats))
-                
-            if  int(toy_ID) in  args.plot:
-                if args.ratio_plot:
-                    TopC, (Upad, Lpad) = aplt.ratio_plot(name="ratio_plot", figsize=(800, 800), hspace=0.05)
-                    Upad.cd()
-                    frame.Draw()
-                    frame.GetXaxis().SetLabelOffset(2)
-                    Upad.add_margins(left=0.15)
-                    # Add the ATLAS Label
-                    aplt.atlas_label(text="Internal", loc="upper left")
-                    #Upad.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
-                    Upad.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
-                    # Add extra space at top of plot to make room for labels
-                    Upad.add_margins(top=0.15)
-                    
-                    Lpad.cd()
-                    residual.GetYaxis().SetRangeUser(res_mean-3.5*res_std, res_mean+3.5*res_std,)
-                    residual.GetYaxis().SetTitle("Data-Fit")
-                    residual.GetYaxis().SetTitleOffset(2)
-                    residual.Draw()
-                    fConfidenceInterval1 = ROOT.TGraphErrors()
-                    fConfidenceInterval2 = ROOT.TGraphErrors()
-                    for i in range(Nr):
-                        if i ==0:
-                            fConfidenceInterval1.AddPoint(0,res_mean)
-                            fConfidenceInterval2.AddPoint(0,res_mean)
-                        elif i == Nr-1:
-                            fConfidenceInterval1.AddPoint(6.28319,res_mean)
-                            fConfidenceInterval2.AddPoint(6.28319,res_mean)
-                        else:
-                            fConfidenceInterval1.AddPoint(hresid.GetPointX(i),res_mean)
-                            fConfidenceInterval2.AddPoint(hresid.GetPointX(i),res_mean)
-                        fConfidenceInterval1.SetPointError(i, 0.0, res_std)
-                        fConfidenceInterval2.SetPointError(i, 0.0, 2*res_std)
-                    
-                    fConfidenceInterval2.GetXaxis().SetRangeUser(0,6.28319)
-                    fConfidenceInterval1.GetXaxis().SetRangeUser(0,6.28319)
-                    fConfidenceInterval2.SetFillColor(ROOT.kGreen);
-                    fConfidenceInterval1.SetFillColor(ROOT.kYellow);
-                    fConfidenceInterval2.Draw("I3")
-                    fConfidenceInterval1.Draw("3")
-                    residual.Draw("same")
-                    
-                    line = ROOT.TLine(0, 0, 6.28319, 0)
-                    Lpad.plot(line)
-                    Lpad.add_margins(left=0.15)
-                    TopC.savefig(("plots/fit_results_"+model_str+"_"+toy_ID+"_residual_12func.pdf"))
-                
-                fitDataFig, fitData = aplt.subplots(1, 1, name="fitplot", figsize=(800, 600))
-                fitData.cd()
-                frame.Draw()
-                # Add the ATLAS Label
-                aplt.atlas_label(text="Internal", loc="upper left")
-                #fitData.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
-                fitData.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
-                fitDataFig.savefig(("plots/fit_results_"+model_str+"_"+toy_ID+"_12func.pdf"))
-                
-                #create profile of mu
-                print("Sday: ", sday.getValV())
-                Scanfig, Scan = aplt.subplots(1, 1, name="Scan", figsize=(800, 600))
-                Scan.cd()
-                frame1 = mu.frame(Bins=1000, Range=(par-err*3, par+err*3), Title=f"{model_str}")
-                chi2_pdf= model.createChi2(sigData,
-                                    ROOT.RooFit.DataError(ROOT.RooAbsData.SumW2))
-                #chi2_pdf.plotOn(frame1, LineColor="r")
-                profile_mu = chi2_pdf.createProfile({mu})
-                profile_mu.plotOn(frame1, LineColor="r")
-                frame1.Draw()
-                Scan.add_margins(left=0.15)
-                #Scan.add_margins(top=0.15)
-                # Add the ATLAS Label
-                aplt.atlas_label(text="Internal", loc="upper left")
-                #Scan.text(0.2, 0.84, "#sqrt{s} = 13 TeV, 139 fb^{-1}", size=22, align=13)
-                Scan.text(0.2, 0.84, "#sqrt{s} = 13 TeV", size=22, align=13)
-                Scanfig.savefig(("plots/profile_chi2PDF_"+model_str+"_"+toy_ID+"_12func.pdf"))
-                #print(f"chi2_pdf: {chi2_pdf.getVal()}")
-                
-        target_file.write('\n') # start new line
-        residual_file.write('\n') # start new line
-        
-    target_file.close()
-    residual_file.close()
-    
     
+    with profiled(args.profile, args.cprofile):
+        run_fit(args)
+    memory.finish()
+
 
 
 
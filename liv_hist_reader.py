@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# histogram readers returning NumPy arrays (edges, contents, sumw2)
+#
+# root   : PyROOT TFile, needs the LCG view
+# uproot : pure python ROOT file reader
+# npz    : plain numpy archive with <h_name>.edges/.contents/.sumw2 arrays
+# pack   : memory-mapped arrays of a whole toy list, see pack_hists.py
+#
+# LatencyReader wraps any of them with simulated remote latency and open
+# failures, to test the read-ahead of iter_read without EOS. MultiHistReader
+# reads several histograms per file with one open.
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from liv_memory import memory
+from liv_profiling import timer
+
+
+class HistReader:
+    name = None
+    #transient open failures (OSError) are retried with exponential backoff
+    retries = 0
+    retry_wait = 1.
+
+    def __init__(self, h_name="h_generated"):
+        self.h_name = h_name
+        #seconds the caller waited for a histogram, and spent in iter_read overall
+        self.starved_s = 0.
+        self.wall_s = 0.
+        self.n_reads = 0
+        self.n_retries = 0
+
+    def read(self, path):
+        """Return (edges, contents, sumw2) of histogram h_name in path."""
+        return self.read_many(path, [self.h_name])[self.h_name]
+
+    def read_many(self, path, h_names):
+        """Return {h_name: (edges, contents, sumw2)} of several histograms, opening path once."""
+        raise NotImplementedError
+
+    def list_hists(self, path):
+        """Names of the 1D histograms in path."""
+        raise NotImplementedError
+
+    def read_retry(self, path):
+        """read, retrying OSError up to self.retries times, a missing histogram is not retried."""
+        for attempt in range(self.retries+1):
+            try:
+                return self.read(path)
+            except OSError as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.retry_wait*2**attempt
+                self.n_retries += 1
+                logging.warning(f"{e}, retry {attempt+1}/{self.retries} in {wait:.1f} s")
+                time.sleep(wait)
+
+    def _wait(self, future):
+        start = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            self.starved_s += time.perf_counter() - start
+
+    def iter_read(self, paths, prefetch=0, threads=None):
+        """Read paths in order, keeping up to `prefetch` files in flight
+        on `threads` (default prefetch) background threads while the caller
+        fits the current one."""
+        start = time.perf_counter()
+        try:
+            if prefetch < 1:
+                for path in paths:
+                    read_start = time.perf_counter()
+                    hist = self.read_retry(path)
+                    self.starved_s += time.perf_counter() - read_start
+                    self.n_reads += 1
+                    yield hist
+                return
+
+            with ThreadPoolExecutor(max_workers=threads or prefetch) as pool:
+                pending = collections.deque()
+                for path in paths:
+                    pending.append(pool.submit(self.read_retry, path))
+                    #above the memory ceiling nothing is read ahead
+                    while len(pending) > prefetch or (pending and memory.over()):
+                        self.n_reads += 1
+                        yield self._wait(pending.popleft())
+                while pending:
+                    self.n_reads += 1
+                    yield self._wait(pending.popleft())
+        finally:
+            self.wall_s += time.perf_counter() - start
+
+    def starved_fraction(self):
+        """Fraction of the time in iter_read the caller was waiting for input."""
+        return self.starved_s/self.wall_s if self.wall_s > 0 else 0.
+
+    def read_all(self, paths, prefetch=0, threads=None):
+        """Stack all histograms into (n_toys, n_bins) arrays, they must share the binning."""
+        edges, contents, sumw2 = None, [], []
+        for path, (_edges, _contents, _sumw2) in zip(paths, self.iter_read(paths, prefetch, threads)):
+            if edges is None:
+                edges = _edges
+            elif len(_edges) != len(edges) or not np.allclose(_edges, edges):
+                raise ValueError(f"sday binning of {path} differs from the first histogram")
+            contents.append(_contents)
+            sumw2.append(_sumw2)
+        return edges, np.array(contents), np.array(sumw2)
+
+
+class RootReader(HistReader):
+    name = "root"
+
+    def __init__(self, h_name="h_generated"):
+        super().__init__(h_name)
+        import ROOT
+        ROOT.gROOT.SetBatch(True)
+        ROOT.EnableThreadSafety()
+        self._ROOT = ROOT
+
+    def open(self, path):
+        with timer.stage("open"):
+            _f = self._ROOT.TFile.Open(path, 'r')
+        if not _f or _f.IsZombie():
+            raise IOError(f"can not open {path}")
+        #the file object is deleted with _f, not kept by ROOT after Close
+        self._ROOT.SetOwnership(_f, True)
+        return _f
+
+    def read_many(self, path, h_names):
+        _f = self.open(path)
+        hists = {}
+        with timer.stage("get"):
+            for h_name in h_names:
+                h = _f.Get(h_name)
+                if not h:
+                    _f.Close()
+                    raise KeyError(f"no histogram {h_name} in {path}")
+                nbins = h.GetNbinsX()
+                axis = h.GetXaxis()
+                edges = np.array([axis.GetBinLowEdge(i) for i in range(1, nbins+2)])
+                contents = np.array([h.GetBinContent(i) for i in range(1, nbins+1)])
+                sumw2 = np.array([h.GetBinError(i) for i in range(1, nbins+1)])**2
+                hists[h_name] = edges, contents, sumw2
+            _f.Close()
+        return hists
+
+    def list_hists(self, path):
+        _f = self.open(path)
+        names = []
+        for key in _f.GetListOfKeys():
+            cls = self._ROOT.TClass.GetClass(key.GetClassName())
+            #TH2 and TH3 inherit from TH1 as well
+            if cls.InheritsFrom("TH1") and not (cls.InheritsFrom("TH2") or cls.InheritsFrom("TH3")):
+                names.append(key.GetName())
+        _f.Close()
+        return names
+
+
+class UprootReader(HistReader):
+    name = "uproot"
+
+    def __init__(self, h_name="h_generated"):
+        super().__init__(h_name)
+        import uproot
+        self._uproot = uproot
+
+    def read_many(self, path, h_names):
+        with timer.stage("open"):
+            _f = self._uproot.open(path)
+        hists = {}
+        with _f, timer.stage("get"):
+            for h_name in h_names:
+                h = _f[h_name]
+                hists[h_name] = (np.asarray(h.axis().edges(), dtype=float), np.asarray(h.values(), dtype=float),
+                                 np.asarray(h.variances(), dtype=float))
+        return hists
+
+    def list_hists(self, path):
+        with self._uproot.open(path) as _f:
+            return [name for name, classname in _f.classnames(cycle=False).items() if classname.startswith("TH1")]
+
+
+class NpzReader(HistReader):
+    name = "npz"
+
+    def read_many(self, path, h_names):
+        with timer.stage("open"):
+            _f = np.load(path)
+        hists = {}
+        with _f, timer.stage("get"):
+            for h_name in h_names:
+                try:
+                    hists[h_name] = _f[f"{h_name}.edges"], _f[f"{h_name}.contents"], _f[f"{h_name}.sumw2"]
+                except KeyError:
+                    raise KeyError(f"no histogram {h_name} in {path}")
+        return hists
+
+    def list_hists(self, path):
+        with np.load(path) as _f:
+            return [name[:-len(".contents")] for name in _f.files if name.endswith(".contents")]
+
+
+def write_npz(path, hists):
+    """Write {h_name: (edges, contents, sumw2)} in the layout read by NpzReader."""
+    arrays = {}
+    for h_name, (edges, contents, sumw2) in hists.items():
+        arrays[f"{h_name}.edges"] = edges
+        arrays[f"{h_name}.contents"] = contents
+        arrays[f"{h_name}.sumw2"] = sumw2
+    np.savez(path, **arrays)
+
+
+class PackReader(HistReader):
+    """Histograms of a pack directory written by write_pack, keys are row indices.
+
+    The arrays are memory-mapped, reading a toy does not copy the pack.
+    """
+    name = "pack"
+
+    def __init__(self, pack_dir):
+        with open(os.path.join(pack_dir, "meta.json"), 'r') as _f:
+            self.meta = json.load(_f)
+        super().__init__(self.meta["h_name"])
+        self.edges = np.load(os.path.join(pack_dir, "edges.npy"))
+        self.contents = np.load(os.path.join(pack_dir, "contents.npy"), mmap_mode='r')
+        self.sumw2 = np.load(os.path.join(pack_dir, "sumw2.npy"), mmap_mode='r')
+        self.toy_IDs = np.load(os.path.join(pack_dir, "toy_ids.npy")).tolist()
+
+    def read(self, index):
+        return self.edges, self.contents[index], self.sumw2[index]
+
+    def read_many(self, index, h_names):
+        missing = [h_name for h_name in h_names if h_name != self.h_name]
+        if missing:
+            raise KeyError(f"no histogram {missing[0]} in the pack, it holds {self.h_name}")
+        return {self.h_name: self.read(index)}
+
+    def list_hists(self, index=None):
+        return [self.h_name]
+
+    def read_all(self, indices, prefetch=0, threads=None):
+        indices = np.asarray(indices)
+        if len(indices) and np.array_equal(indices, np.arange(indices[0], indices[-1]+1)):
+            #contiguous rows stay a view on the memory map
+            rows = slice(indices[0], indices[-1]+1)
+            return self.edges, self.contents[rows], self.sumw2[rows]
+        return self.edges, self.contents[indices], self.sumw2[indices]
+
+
+def write_pack(pack_dir, reader, paths, toy_IDs, prefetch=0):
+    """Read every histogram once and write one contiguous array per quantity."""
+    os.makedirs(pack_dir, exist_ok=True)
+    contents = sumw2 = edges = None
+    for i, (path, (_edges, _contents, _sumw2)) in enumerate(zip(paths, reader.iter_read(paths, prefetch))):
+        if edges is None:
+            edges = _edges
+            shape = (len(paths), len(_contents))
+            contents = np.lib.format.open_memmap(os.path.join(pack_dir, "contents.npy"), mode='w+', shape=shape)
+            sumw2 = np.lib.format.open_memmap(os.path.join(pack_dir, "sumw2.npy"), mode='w+', shape=shape)
+        elif len(_edges) != len(edges) or not np.allclose(_edges, edges):
+            raise ValueError(f"sday binning of {path} differs from the first histogram")
+        contents[i] = _contents
+        sumw2[i] = _sumw2
+        if (i+1) % 1000 == 0:
+            logging.info(f"packed {i+1}/{len(paths)} histograms")
+    if edges is None:
+        raise ValueError("no histograms to pack")
+    contents.flush()
+    sumw2.flush()
+    np.save(os.path.join(pack_dir, "edges.npy"), edges)
+    np.save(os.path.join(pack_dir, "toy_ids.npy"), np.array(toy_IDs, dtype=str))
+    with open(os.path.join(pack_dir, "meta.json"), 'w') as _f:
+        json.dump({"h_name": reader.h_name, "n_toys": len(paths), "n_bins": len(edges)-1,
+                   "paths": list(paths)}, _f, indent=1)
+
+
+class LatencyReader(HistReader):
+    """Local stand-in for a remote store, for testing the read-ahead.
+
+    Every read of the wrapped reader is delayed by an exponentially
+    distributed latency and a fraction of the opens fail with an OSError.
+    """
+    def __init__(self, reader, latency=0.05, failure_rate=0., seed=0):
+        super().__init__(reader.h_name)
+        self.reader = reader
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+
+    def read_many(self, path, h_names):
+        with timer.stage("open"):
+            if self.latency > 0:
+                time.sleep(self._rng.expovariate(1./self.latency))
+            if self._rng.random() < self.failure_rate:
+                raise OSError(f"simulated transient failure opening {path}")
+        return self.reader.read_many(path, h_names)
+
+    def list_hists(self, path):
+        return self.reader.list_hists(path)
+
+
+class MultiHistReader(HistReader):
+    """Several histograms per file, read with keys (path, h_name, ...).
+
+    The first key of a file reads all h_names of it at once, the other keys
+    of the file are answered from memory, also when they are read on other
+    threads at the same time. A file leaves memory once all its histograms
+    were read, or when more than max_files files are pending.
+    """
+    def __init__(self, reader, h_names, max_files=64):
+        super().__init__(reader.h_name)
+        self.reader = reader
+        self.h_names = list(h_names)
+        self.max_files = max_files
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, key):
+        path, h_name = key[0], key[1]
+        with self._lock:
+            entry = self._files.get(path)
+            owner = entry is None
+            if owner:
+                entry = self._files[path] = [Future(), 0]
+                while len(self._files) > self.max_files:
+                    self._files.popitem(last=False)
+            entry[1] += 1
+            if entry[1] == len(self.h_names):
+                self._files.pop(path, None)
+        if owner:
+            try:
+                entry[0].set_result(self.reader.read_many(path, self.h_names))
+            except BaseException as e:
+                #a retry opens the file again
+                with self._lock:
+                    if self._files.get(path) is entry:
+                        del self._files[path]
+                entry[0].set_exception(e)
+        return entry[0].result()[h_name]
+
+    def read_many(self, path, h_names):
+        return self.reader.read_many(path, h_names)
+
+    def list_hists(self, path):
+        return self.reader.list_hists(path)
+
+
+readers = {reader.name: reader for reader in [RootReader, UprootReader, NpzReader]}
+
+def get_reader(name, h_name="h_generated"):
+    return readers[name](h_name)
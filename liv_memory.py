@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# resident memory of the fit loop
+#
+#   memory.configure(max_mb=2000, every=1000, log_path="rss.csv")
+#   ...
+#   if memory.over():      #producers stop reading ahead while True
+#   memory.end_toy()
+#
+# over() is the soft ceiling: above max_mb it runs the garbage collector and
+# stays True until the RSS is back below, read-ahead and worker submission
+# wait on it. Once any option is configured, end_toy samples the RSS of every
+# toy and prints the current RSS, the peak of the toys since the last report
+# and the peak RSS of the process every `every` toys.
+
+import gc
+import logging
+import os
+import resource
+
+_page_mb = os.sysconf("SC_PAGE_SIZE")/2**20 if hasattr(os, "sysconf") else None
+
+
+def peak_rss_mb():
+    #ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def rss_mb():
+    """Current resident set size, the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm", 'r') as _f:
+            return int(_f.read().split()[1])*_page_mb
+    except (OSError, TypeError):
+        return peak_rss_mb()
+
+
+class MemoryGuard:
+    def __init__(self):
+        self.configure()
+
+    def configure(self, max_mb=None, every=None, log_path=None):
+        self.max_mb = max_mb
+        self.every = every or 1000
+        #no /proc read per toy unless something is reported
+        self.active = max_mb is not None or every is not None or log_path is not None
+        self.log_path = log_path
+        self.n = 0
+        self.window_start = 0
+        self.window_peak = 0.
+        self.throttled = 0
+        self._warned = False
+        if log_path:
+            with open(log_path, 'w') as _f:
+                _f.write('"toys","window_toys","rss_mb","window_peak_mb","peak_rss_mb","throttled"\n')
+
+    def over(self):
+        """True while the RSS is above the ceiling after a garbage collection."""
+        if self.max_mb is None or rss_mb() <= self.max_mb:
+            return False
+        gc.collect()
+        rss = rss_mb()
+        if rss <= self.max_mb:
+            return False
+        self.throttled += 1
+        if not self._warned:
+            logging.warning(f"RSS {rss:.0f} MB above the ceiling of {self.max_mb:.0f} MB, throttling read-ahead")
+            self._warned = True
+        return True
+
+    def end_toy(self):
+        self.n += 1
+        if not self.active:
+            return
+        self.window_peak = max(self.window_peak, rss_mb())
+        if self.n % self.every == 0:
+            self.report()
+
+    def report(self):
+        rss = rss_mb()
+        self.window_peak = max(self.window_peak, rss)
+        window = self.n - self.window_start
+        print(f"{self.n} toys: RSS {rss:.1f} MB, peak in the last {window} toys "
+              f"{self.window_peak:.1f} MB, process peak {peak_rss_mb():.1f} MB, throttled {self.throttled}")
+        if self.log_path:
+            with open(self.log_path, 'a') as _f:
+                _f.write(f"{self.n},{window},{rss:.3f},{self.window_peak:.3f},{peak_rss_mb():.3f},{self.throttled}\n")
+        self.window_start = self.n
+        self.window_peak = 0.
+        self._warned = False
+
+    def finish(self):
+        #the last, partial window
+        if self.active and self.n > self.window_start:
+            self.report()
+
+
+memory = MemoryGuard()
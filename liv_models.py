@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# sidereal modulation models, kept free of ROOT so that the NumPy fit engine
+# can use them without the LCG view
+
+import json
+import re
+
+import numpy as np
+
+models = ["d[u,X,Z]", "d[u,Y,Z]", "d[u,X-Y,X-Y]", "d[u,X,Y]",
+          "c[u,X,Z]", "c[u,Y,Z]", "c[u,X-Y,X-Y]", "c[u,X,Y]",
+          "c[d,X,Z]", "c[d,Y,Z]", "c[d,X-Y,X-Y]", "c[d,X,Y]"]
+
+basis_functions = ["cos(sday)", "sin(sday)", "cos(2*sday)", "sin(2*sday)"]
+
+#models registered as coefficient vectors against basis_functions
+extra_models = {}
+
+def get_model_str(coeff):
+    if coeff in extra_models:
+        terms = [f"{c:+.10g}*{f}" for c, f in zip(extra_models[coeff], basis_functions) if c]
+        return "1+mu*(" + "".join(terms).lstrip('+') + ")"
+    
+    m_list = {"d[u,X,Z]" : "1+mu*(6.28069*cos(sday)-41.0569*sin(sday))",
+        "d[u,Y,Z]" : "1+mu*(41.0569*cos(sday)+6.28069*sin(sday))",
+        "d[u,X-Y,X-Y]" : "1+mu*(77.6067*cos(2*sday)+24.3128*sin(2*sday))",
+        "d[u,X,Y]" :  "1+mu*(-48.6256*cos(2*sday)+155.213*sin(2*sday))",
+        "c[u,X,Z]" : "1+mu*(8.084*cos(sday)-52.8451*sin(sday))",
+        "c[u,Y,Z]" : "1+mu*(52.8451*cos(sday)+8.084*sin(sday))",
+        "c[u,X-Y,X-Y]" : "1+mu*(99.8891*cos(2*sday)+31.2935*sin(2*sday))",
+        "c[u,X,Y]" : "1+mu*(-62.5869*cos(2*sday)+199.778*sin(2*sday))",
+        "c[d,X,Z]" : "1+mu*(0.181551*cos(sday)-1.1868*sin(sday))",
+        "c[d,Y,Z]" : "1+mu*(1.1868*cos(sday)+0.181551*sin(sday))",
+        "c[d,X-Y,X-Y]" : "1+mu*(2.24331*cos(2*sday)+0.702788*sin(2*sday))",
+        "c[d,X,Y]" : "1+mu*(-1.40558*cos(2*sday)+4.48662*sin(2*sday))"
+    }
+
+    return m_list[coeff]
+
+
+_term_regex = re.compile(r"([+-]?[0-9.]+)\*(cos|sin)\((?:([0-9]+)\*)?sday\)")
+
+def get_model_vector(coeff):
+    """Coefficients of a model against basis_functions, 1+mu*(vector.basis)."""
+    if coeff in extra_models:
+        return list(extra_models[coeff])
+    vector = [0.]*len(basis_functions)
+    terms = _term_regex.findall(get_model_str(coeff))
+    if not terms:
+        raise ValueError(f"can not parse model {coeff}")
+    for amp, func, harmonic in terms:
+        harmonic = int(harmonic) if harmonic else 1
+        if harmonic > len(basis_functions)//2:
+            raise ValueError(f"model {coeff} uses harmonic {harmonic}")
+        vector[2*(harmonic-1) + (func == "sin")] = float(amp)
+    return vector
+
+
+def get_model_terms(coeff):
+    """Return (k, a, b) of a model 1+mu*(a*cos(k*sday)+b*sin(k*sday))."""
+    vector = get_model_vector(coeff)
+    harmonics = [k for k in range(1, len(vector)//2+1) if vector[2*k-2] or vector[2*k-1]]
+    if len(harmonics) != 1:
+        raise ValueError(f"model {coeff} is not a single sidereal harmonic")
+    k = harmonics[0]
+    return k, vector[2*k-2], vector[2*k-1]
+
+
+def register_model(coeff, vector):
+    """Add a model given as coefficients against basis_functions."""
+    if len(vector) != len(basis_functions):
+        raise ValueError(f"model {coeff} needs {len(basis_functions)} coefficients")
+    if coeff in models and coeff not in extra_models:
+        raise ValueError(f"model {coeff} already exists")
+    extra_models[coeff] = [float(c) for c in vector]
+    if coeff not in models:
+        models.append(coeff)
+
+
+def load_extra_models(path):
+    """Register the models of a json file {name: [cos, sin, cos2, sin2]}."""
+    with open(path, 'r') as _f:
+        for coeff, vector in json.load(_f).items():
+            register_model(coeff, vector)
+
+
+def joint_presets(model_list=None):
+    """Named groups for joint fits, every family (e.g. d[u]) and its
+    same-harmonic pairs (e.g. d[u]h1)."""
+    if model_list is None:
+        model_list = models
+    groups = {}
+    for coeff in model_list:
+        if '[' not in coeff:
+            continue
+        family = coeff.split(',')[0] + ']'
+        try:
+            k = get_model_terms(coeff)[0]
+        except ValueError:
+            continue
+        groups.setdefault(family, []).append(coeff)
+        groups.setdefault(f"{family}h{k}", []).append(coeff)
+    return groups
+
+
+#smallest singular value of the normalised model vectors of a joint group
+collinear_tolerance = 1e-3
+
+def get_joint_group(spec):
+    """Models of a joint fit, a preset name or model names joined by '+'.
+
+    The models must be linearly independent, e.g. d[u,X,Z] and c[u,X,Z]
+    have the same shape up to rounding and can not be fitted together.
+    """
+    presets = joint_presets()
+    group = presets[spec] if spec in presets else spec.split('+')
+    unknown = [coeff for coeff in group if coeff not in models]
+    if unknown:
+        raise ValueError(f"unknown models {unknown} in joint group {spec}")
+    if len(set(group)) != len(group):
+        raise ValueError(f"joint group {spec} repeats a model")
+    vectors = np.array([get_model_vector(coeff) for coeff in group])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    if np.linalg.svd(vectors, compute_uv=False)[-1] < collinear_tolerance:
+        raise ValueError(f"models of joint group {spec} are not linearly independent")
+    return group
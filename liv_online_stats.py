@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# streaming ensemble statistics of the fit results, updated while toys are
+# fitted and mergeable across --chunk shards
+#
+# per model: Welford mean/variance of mu, err, chi2, chi2_p0 and the pull
+# (mu-truth)/err, fixed-bin histograms of pull, chi2 and chi2_p0, and the
+# number of toys covering the truth within 1 and 2 err. Dumps are json,
+# merge shards with
+#   python liv_online_stats.py --inputs shard0.json shard1.json --output all.json
+
+import sys
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from scipy import special
+
+quantities = ["par", "err", "chi2", "chi2_p0", "pull"]
+hist_ranges = {"pull": (-5., 5., 50), "chi2": (0., 100., 50), "chi2_p0": (0., 1., 20)}
+
+
+class Welford:
+    """Running mean and sum of squared deviations of every column."""
+    def __init__(self, n_columns):
+        self.n = 0
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+
+    def update(self, values):
+        #Chan et al. combination of the running and the batch moments
+        values = np.atleast_2d(values)
+        other = Welford(values.shape[1])
+        other.n = len(values)
+        other.mean = values.mean(axis=0)
+        other.m2 = ((values - other.mean)**2).sum(axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.n/n
+        self.m2 = self.m2 + other.m2 + delta**2*self.n*other.n/n
+        self.n = n
+
+    def std(self):
+        return np.sqrt(self.m2/(self.n - 1)) if self.n > 1 else np.full_like(self.mean, np.nan)
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean.tolist(), "m2": self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        out = cls(len(d["mean"]))
+        out.n, out.mean, out.m2 = d["n"], np.array(d["mean"]), np.array(d["m2"])
+        return out
+
+
+class FixedHist:
+    """Histogram of every column with fixed bins, under- and overflow."""
+    def __init__(self, n_columns, low, high, n_bins):
+        self.edges = np.linspace(low, high, n_bins+1)
+        self.counts = np.zeros((n_columns, n_bins), dtype=np.int64)
+        self.under = np.zeros(n_columns, dtype=np.int64)
+        self.over = np.zeros(n_columns, dtype=np.int64)
+
+    def update(self, values):
+        values = np.atleast_2d(values)
+        n_bins = len(self.edges) - 1
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        #the upper edge belongs to the last bin
+        index[values == self.edges[-1]] = n_bins - 1
+        self.under += np.count_nonzero(index < 0, axis=0)
+        self.over += np.count_nonzero(index >= n_bins, axis=0)
+        for column, idx in enumerate(index.T):
+            idx = idx[(idx >= 0) & (idx < n_bins)]
+            self.counts[column] += np.bincount(idx, minlength=n_bins)
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("histograms with different binning can not be merged")
+        self.counts += other.counts
+        self.under += other.under
+        self.over += other.over
+
+    def to_dict(self):
+        return {"edges": self.edges.tolist(), "counts": self.counts.tolist(),
+                "under": self.under.tolist(), "over": self.over.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        counts = np.array(d["counts"], dtype=np.int64)
+        out = cls(len(counts), d["edges"][0], d["edges"][-1], len(d["edges"])-1)
+        out.edges = np.array(d["edges"])
+        out.counts, out.under, out.over = counts, np.array(d["under"]), np.array(d["over"])
+        return out
+
+
+class EnsembleStats:
+    """Online statistics of the single-model fit results of an ensemble."""
+    def __init__(self, model_list, truth=0.):
+        self.models = list(model_list)
+        self.truth = truth
+        n = len(self.models)
+        self.moments = {q: Welford(n) for q in quantities}
+        self.hists = {q: FixedHist(n, *r) for q, r in hist_ranges.items()}
+        self.covered = {1: np.zeros(n, dtype=np.int64), 2: np.zeros(n, dtype=np.int64)}
+        self._pending = []
+
+    @property
+    def n(self):
+        return self.moments["par"].n + len(self._pending)
+
+    def add(self, results):
+        """Queue the flat (par, err, chi2, chi2_p0)*n_models row of one toy."""
+        self._pending.append(results)
+
+    def flush(self):
+        #one vectorised update per batch of toys
+        if not self._pending:
+            return
+        rows = np.reshape(self._pending, (len(self._pending), len(self.models), 4))
+        self._pending = []
+        values = {"par": rows[..., 0], "err": rows[..., 1], "chi2": rows[..., 2], "chi2_p0": rows[..., 3]}
+        values["pull"] = (values["par"] - self.truth)/values["err"]
+        for q in quantities:
+            self.moments[q].update(values[q])
+        for q, hist in self.hists.items():
+            hist.update(values[q])
+        for n_sigma, covered in self.covered.items():
+            covered += np.count_nonzero(np.abs(values["pull"]) < n_sigma, axis=0)
+
+    def merge(self, other):
+        if other.models != self.models or other.truth != self.truth:
+            raise ValueError("statistics of different models or truth can not be merged")
+        self.flush()
+        other.flush()
+        for q in quantities:
+            self.moments[q].merge(other.moments[q])
+        for q in self.hists:
+            self.hists[q].merge(other.hists[q])
+        for n_sigma in self.covered:
+            self.covered[n_sigma] += other.covered[n_sigma]
+
+    def summary(self):
+        """Bias, pull width, coverage and p-value uniformity per model."""
+        self.flush()
+        n = self.moments["par"].n
+        pull_std = self.moments["pull"].std()
+        p0 = self.hists["chi2_p0"].counts
+        expected = p0.sum(axis=1, keepdims=True)/p0.shape[1]
+        uniform_chi2 = np.divide(((p0 - expected)**2).sum(axis=1), expected[:, 0],
+                                 out=np.zeros(len(self.models)), where=expected[:, 0] > 0)
+        out = {}
+        for i, model_str in enumerate(self.models):
+            out[model_str] = {"n": n, "mean": self.moments["par"].mean[i], "std": self.moments["par"].std()[i],
+                              "err_mean": self.moments["err"].mean[i], "chi2_mean": self.moments["chi2"].mean[i],
+                              "pull_mean": self.moments["pull"].mean[i], "pull_std": pull_std[i],
+                              "pull_mean_err": pull_std[i]/np.sqrt(n) if n > 0 else np.nan,
+                              "p0_uniform_chi2": uniform_chi2[i],
+                              "p0_uniform_p": special.chdtrc(p0.shape[1]-1, uniform_chi2[i])}
+            for n_sigma, covered in self.covered.items():
+                coverage = covered[i]/n if n > 0 else np.nan
+                out[model_str][f"coverage{n_sigma}"] = coverage
+                out[model_str][f"coverage{n_sigma}_err"] = np.sqrt(coverage*(1-coverage)/n) if n > 0 else np.nan
+        return out
+
+    def converged(self, tolerance, min_toys=100):
+        """True once the bias and 1 sigma coverage of every model are known to tolerance."""
+        summary = self.summary()
+        if self.n < min_toys:
+            return False
+        return all(s["pull_mean_err"] < tolerance and s["coverage1_err"] < tolerance for s in summary.values())
+
+    def to_dict(self):
+        self.flush()
+        return {"models": self.models, "truth": self.truth, "n": self.n,
+                "moments": {q: w.to_dict() for q, w in self.moments.items()},
+                "hists": {q: h.to_dict() for q, h in self.hists.items()},
+                "covered": {str(k): v.tolist() for k, v in self.covered.items()},
+                "summary": self.summary()}
+
+    @classmethod
+    def from_dict(cls, d):
+        out = cls(d["models"], d["truth"])
+        out.moments = {q: Welford.from_dict(w) for q, w in d["moments"].items()}
+        out.hists = {q: FixedHist.from_dict(h) for q, h in d["hists"].items()}
+        out.covered = {int(k): np.array(v, dtype=np.int64) for k, v in d["covered"].items()}
+        return out
+
+    def dump(self, path):
+        #write and rename, a reader never sees a partial file
+        with open(f"{path}.tmp", 'w') as _f:
+            json.dump(self.to_dict(), _f, indent=1)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as _f:
+            return cls.from_dict(json.load(_f))
+
+
+def print_summary(stats):
+    print(f"{stats.n} toys, truth {stats.truth}")
+    print(f"{'model':14} {'pull mean':>14} {'pull std':>9} {'cov 1s':>7} {'cov 2s':>7} {'p0 unif p':>9}")
+    for model_str, s in stats.summary().items():
+        print(f"{model_str:14} {s['pull_mean']:7.3f}+-{s['pull_mean_err']:5.3f} {s['pull_std']:9.3f} "
+              f"{s['coverage1']:7.3f} {s['coverage2']:7.3f} {s['p0_uniform_p']:9.3f}")
+
+
+def merge_online_stats(coms=None):
+    argparser = argparse.ArgumentParser(description='merge online ensemble statistics of fit shards')
+    argparser.add_argument('--inputs', required=True, nargs='+', type=str, help='json dumps of the shards')
+    argparser.add_argument('--output', required=True, type=str, help='merged json')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    merged = None
+    for path in args.inputs:
+        stats = EnsembleStats.load(path)
+        try:
+            if merged is None:
+                merged = stats
+            else:
+                merged.merge(stats)
+        except ValueError as e:
+            logging.error(f"{path}: {e}!")
+            sys.exit()
+    merged.dump(args.output)
+    print_summary(merged)
+
+
+def main():
+    merge_online_stats()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# per-stage timing of the fit loop
+#
+#   with timer.stage("fit"):
+#       ...
+#   timer.end_toy(toy_ID)
+#
+# Stage times are summed until end_toy, which books them to that toy. The
+# module timer is disabled by default, stage() then returns a shared no-op
+# context manager, so instrumented code costs one attribute lookup.
+
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+percentiles = [50, 90, 99]
+
+_disabled = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.toys = []
+        self.calls = collections.Counter()
+        self._current = collections.defaultdict(float)
+        self.start = time.perf_counter()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _disabled
+        return _Stage(self, name)
+
+    def add(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        #reader threads of --prefetch book here as well
+        with self._lock:
+            self._current[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.calls[name] += n
+
+    def pop(self):
+        """Stage times since the last end_toy, e.g. to send them from a worker process."""
+        with self._lock:
+            current, self._current = dict(self._current), collections.defaultdict(float)
+        return current
+
+    def merge(self, stages):
+        for name, seconds in stages.items():
+            self.add(name, seconds)
+
+    def end_toy(self, toy_ID):
+        if self.enabled:
+            self.toys.append((toy_ID, self.pop()))
+
+    def stages(self):
+        names = []
+        for _, row in self.toys:
+            names += [name for name in row if name not in names]
+        return names
+
+    def summary(self):
+        """Per stage: calls, toys, mean/percentiles/max per toy in ms, total s and share of the wall time."""
+        wall = time.perf_counter() - self.start
+        summary = {}
+        for name in self.stages():
+            seconds = np.array([row.get(name, 0.) for _, row in self.toys])
+            summary[name] = {"calls": self.calls[name], "n": len(seconds), "mean_ms": 1e3*seconds.mean(),
+                             **{f"p{p}_ms": 1e3*np.percentile(seconds, p) for p in percentiles},
+                             "max_ms": 1e3*seconds.max(), "total_s": seconds.sum(),
+                             "share": seconds.sum()/wall if wall > 0 else 0.}
+        return summary
+
+    def write_table(self, path):
+        #one row per toy, one column per stage in seconds
+        names = self.stages()
+        with open(path, 'w') as _f:
+            _f.write(','.join(f'"{c}"' for c in ["sample ID"] + names)+'\n')
+            for toy_ID, row in self.toys:
+                _f.write(','.join([str(toy_ID)] + [repr(row.get(name, 0.)) for name in names])+'\n')
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{len(self.toys)} toys in {time.perf_counter() - self.start:.2f} s")
+        print(f"{'stage':12} {'calls':>8} {'mean ms':>10}" + "".join(f" {'p'+str(p)+' ms':>10}" for p in percentiles)
+              + f" {'total s':>10} {'share':>6}")
+        for name, s in summary.items():
+            print(f"{name:12} {s['calls']:8d} {s['mean_ms']:10.4f}" + "".join(f" {s[f'p{p}_ms']:10.4f}" for p in percentiles)
+                  + f" {s['total_s']:10.3f} {s['share']:6.1%}")
+
+    def dump(self, prefix):
+        """Write <prefix>_stages.csv and <prefix>_summary.json and print the summary."""
+        self.write_table(f"{prefix}_stages.csv")
+        with open(f"{prefix}_summary.json", 'w') as _f:
+            json.dump({"n_toys": len(self.toys), "wall_s": time.perf_counter() - self.start,
+                       "stages": self.summary()}, _f, indent=1)
+        self.print_summary()
+
+
+timer = StageTimer()
+
+
+@contextlib.contextmanager
+def profiled(prefix=None, use_cprofile=False):
+    """Enable the module timer for the block and dump it to prefix, optionally under cProfile."""
+    if prefix is None and not use_cprofile:
+        yield
+        return
+    if prefix:
+        timer.enable()
+    profiler = cProfile.Profile() if use_cprofile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f"{prefix or 'profile'}.prof")
+            logging.info(f"cProfile stats written to {prefix or 'profile'}.prof")
+        if prefix:
+            timer.dump(prefix)
+            timer.enable(False)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# persistent fit-result cache, so reruns only fit new or changed toys
+#
+# entries are keyed by a hash of the input (path + mtime/size or content
+# hash), histogram name, model strings and fit options. The store is a
+# single sqlite file with least-recently-used eviction above a size cap.
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+def make_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def file_fingerprint(path, content=False):
+    """Content hash, or (abspath, mtime, size) of a file."""
+    if content:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as _f:
+            for block in iter(lambda: _f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        #e.g. root:// urls, only the path identifies the input
+        logging.debug(f"can not stat {path}, caching by path only")
+        return [path]
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+class ResultCache:
+    def __init__(self, path, max_mb=512, commit_every=50):
+        self.max_bytes = int(max_mb*1024**2)
+        self.commit_every = commit_every
+        self._pending = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        row = self._db.execute("SELECT value FROM results WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE results SET last_used=? WHERE key=?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                         (key, value, len(value), time.time()))
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.evict()
+        self._db.commit()
+        self._pending = 0
+
+    def evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+        drop = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM results WHERE key=?", drop)
+        logging.info(f"result cache: evicted {len(drop)} entries")
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# fit result writers, one row per toy
+#
+# txt   : legacy space separated fit and residual files, no header
+# csv   : one file with a header and named columns for every model
+# arrow : Arrow IPC file of record batches, needs pyarrow
+#
+# csv and arrow rows are written in batches of complete rows, so a crashed
+# job leaves a readable file, and resume=True continues after the last row.
+#
+# Every writer also keeps a sidecar index <output>.idx with one line per toy,
+# "toy_ID byte_offset" (txt, csv) or "toy_ID batch row" (arrow), so that
+# read_samples fetches single toys without loading the whole file. The arrow
+# footer lets it read only the indexed batches; a file left without footer by
+# a crash is still read batch by batch.
+
+import io
+import logging
+import os
+
+import numpy as np
+
+from liv_fast_fit import n_fourier_harmonics
+from liv_models import models
+
+fit_columns = ["", "_err", "_chi2", "_chi2_p0"]
+residual_columns = ["_res_mean", "_res_std"]
+diagnostic_columns = (["_pull_mean", "_pull_std", "_runs_z", "_runs_p"]
+                      + [f"_fourier{k}" for k in range(1, n_fourier_harmonics+1)])
+
+
+def result_columns(model_list=models, diagnostics=False):
+    """Named columns of the csv/arrow output, in row order."""
+    columns = ["sample ID"]
+    columns += [f"{m}{c}" for m in model_list for c in fit_columns]
+    columns += [f"{m}{c}" for m in model_list for c in residual_columns]
+    columns += ["res_err_mean"]
+    if diagnostics:
+        columns += [f"{m}{c}" for m in model_list for c in diagnostic_columns]
+    return columns
+
+
+def joint_columns(groups):
+    """Columns of the joint fits of {group name: models}: par and err of
+    every model, chi2, chi2_p0 and the upper triangle of the covariance."""
+    columns = ["sample ID"]
+    for name, group in groups.items():
+        columns += [f"{name}:{m}{c}" for m in group for c in ["", "_err"]]
+        columns += [f"{name}_chi2", f"{name}_chi2_p0"]
+        columns += [f"{name}_cov[{m1}|{m2}]" for i, m1 in enumerate(group) for m2 in group[i:]]
+    return columns
+
+
+def ensemble_rows(fit):
+    #one row of par err chi2 chi2_p0 and one of residual mean std per toy,
+    #followed by the residual diagnostics of every model if present
+    results = np.stack([fit["par"], fit["err"], fit["chi2"], fit["chi2_p0"]], axis=-1)
+    n_toys = len(results)
+    residuals = [np.stack([fit["res_mean"], fit["res_std"]], axis=-1).reshape(n_toys, -1),
+                 fit["res_err_mean"][:, None]]
+    if "runs_z" in fit:
+        diagnostics = np.stack([fit["pull_mean"], fit["pull_std"], fit["runs_z"], fit["runs_p"]], axis=-1)
+        residuals.append(np.concatenate([diagnostics, fit["fourier"]], axis=-1).reshape(n_toys, -1))
+    return results.reshape(n_toys, -1).tolist(), np.concatenate(residuals, axis=1).tolist()
+
+
+def joint_rows(fit):
+    #par err of every model, chi2, chi2_p0 and the upper covariance triangle per toy
+    n_toys, n_par = fit["par"].shape
+    upper = np.triu_indices(n_par)
+    return np.concatenate([np.stack([fit["par"], fit["err"]], axis=-1).reshape(n_toys, -1),
+                           fit["chi2"][:, None], fit["chi2_p0"][:, None],
+                           fit["cov"][:, upper[0], upper[1]]], axis=1)
+
+
+def index_path(path):
+    return f"{path}.idx"
+
+
+class ResultWriter:
+    def __init__(self, path, batch_size=100, resume=False, diagnostics=False, columns=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.columns = columns or result_columns(diagnostics=diagnostics)
+        self._rows = []
+        self.done = set()
+        self._index_file = None
+
+    def open_index(self, entries=()):
+        #index lines are written after their rows are flushed, so they never
+        #point to a partial row
+        self._index_file = open(index_path(self.path), 'w')
+        self.write_index(entries)
+
+    def write_index(self, entries):
+        self._index_file.write(''.join(' '.join(str(x) for x in entry)+'\n' for entry in entries))
+        self._index_file.flush()
+
+    def write(self, toy_ID, results, residuals=()):
+        self._rows.append([str(toy_ID)] + list(results) + list(residuals))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+        if self._index_file:
+            self._index_file.close()
+
+
+class TxtWriter(ResultWriter):
+    def __init__(self, path, residual_path="residual_12func.txt", batch_size=100, resume=False,
+                 diagnostics=False):
+        super().__init__(path, batch_size, diagnostics=diagnostics)
+        if resume:
+            raise ValueError("resume needs the csv or arrow output format")
+        self.target_file = open(path, 'w')
+        self.residual_file = open(residual_path, 'w')
+        self._n_fit = len(models)*len(fit_columns)
+        self._offset = 0
+        self.open_index()
+
+    def flush(self):
+        entries = []
+        for row in self._rows:
+            line = ' '.join(str(x) for x in row[:1+self._n_fit])+' \n'
+            self.target_file.write(line)
+            self.residual_file.write(' '.join(str(x) for x in row[:1]+row[1+self._n_fit:])+'\n')
+            entries.append((row[0], self._offset))
+            self._offset += len(line.encode())
+        self._rows = []
+        self.target_file.flush()
+        self.residual_file.flush()
+        self.write_index(entries)
+
+    def close(self):
+        super().close()
+        self.target_file.close()
+        self.residual_file.close()
+
+
+class CsvWriter(ResultWriter):
+    def __init__(self, path, batch_size=100, resume=False, diagnostics=False, columns=None):
+        super().__init__(path, batch_size, diagnostics=diagnostics, columns=columns)
+        header = ','.join(f'"{c}"' for c in self.columns)+'\n'
+        #an empty file is left by a crash before the first batch
+        if resume and os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'r') as _f:
+                lines = _f.readlines()
+            if lines[0] != header:
+                raise ValueError(f"{path} was not written with the same columns")
+            #drop a partial last row left by a crash
+            rows = [line for line in lines[1:] if line.endswith('\n')]
+            self.done = {line.split(',', 1)[0] for line in rows}
+            with open(path, 'w') as _f:
+                _f.writelines([header] + rows)
+            self.target_file = open(path, 'a')
+        else:
+            rows = []
+            self.target_file = open(path, 'w')
+            self.target_file.write(header)
+            self.target_file.flush()
+        self._offset = len(header.encode())
+        entries = []
+        for line in rows:
+            entries.append((line.split(',', 1)[0], self._offset))
+            self._offset += len(line.encode())
+        self.open_index(entries)
+
+    def flush(self):
+        if self._rows:
+            #one write per batch of complete lines
+            lines = [','.join(repr(float(x)) if i else x for i, x in enumerate(row))+'\n' for row in self._rows]
+            self.target_file.write(''.join(lines))
+            self.target_file.flush()
+            entries = []
+            for row, line in zip(self._rows, lines):
+                entries.append((row[0], self._offset))
+                self._offset += len(line.encode())
+            self.write_index(entries)
+        self._rows = []
+
+    def close(self):
+        super().close()
+        self.target_file.close()
+
+
+class ArrowWriter(ResultWriter):
+    def __init__(self, path, batch_size=100, resume=False, diagnostics=False, columns=None):
+        super().__init__(path, batch_size, diagnostics=diagnostics, columns=columns)
+        import pyarrow as pa
+        import pyarrow.ipc
+        self._pa = pa
+        self.schema = pa.schema([(c, pa.string() if i == 0 else pa.float64()) for i, c in enumerate(self.columns)])
+
+        batches = []
+        if resume and os.path.exists(path):
+            #read into memory, the file is rewritten below
+            schema, batches = arrow_batches(path)
+            if schema is not None and schema != self.schema:
+                raise ValueError(f"{path} was not written with the same columns")
+            for batch in batches:
+                self.done.update(batch.column(0).to_pylist())
+
+        self._sink = pa.OSFile(path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, self.schema)
+        for batch in batches:
+            self._writer.write_batch(batch)
+        self._n_batches = len(batches)
+        self.open_index([(toy_ID, i, row) for i, batch in enumerate(batches)
+                         for row, toy_ID in enumerate(batch.column(0).to_pylist())])
+
+    def flush(self):
+        if self._rows:
+            columns = list(zip(*self._rows))
+            self._writer.write_batch(self._pa.record_batch(
+                [self._pa.array(c, type=f.type) for c, f in zip(columns, self.schema)], schema=self.schema))
+            self._sink.flush()
+            self.write_index([(row[0], self._n_batches, i) for i, row in enumerate(self._rows)])
+            self._n_batches += 1
+        self._rows = []
+
+    def close(self):
+        super().close()
+        self._writer.close()
+        self._sink.close()
+
+
+writers = {"txt": TxtWriter, "csv": CsvWriter, "arrow": ArrowWriter}
+
+
+def open_writer(fmt, path, residual_path="residual_12func.txt", resume=False, diagnostics=False, groups=None):
+    """Writer of the per model rows, or of the joint fits of groups {group name: models}."""
+    if groups:
+        if fmt == "txt":
+            raise ValueError("joint fits need the csv or arrow output format")
+        return writers[fmt](path, resume=resume, columns=joint_columns(groups))
+    if fmt == "txt":
+        return TxtWriter(path, residual_path, resume=resume, diagnostics=diagnostics)
+    return writers[fmt](path, resume=resume, diagnostics=diagnostics)
+
+
+def arrow_batches(path):
+    """Schema and record batches of an arrow result file, also of one without footer or a legacy stream."""
+    import pyarrow as pa
+    import pyarrow.ipc
+    with open(path, 'rb') as _f:
+        data = pa.py_buffer(_f.read())
+    try:
+        reader = pa.ipc.open_file(data)
+        return reader.schema, [reader.get_batch(i) for i in range(reader.num_record_batches)]
+    except pa.ArrowInvalid:
+        pass
+    #no footer: after the 8 byte magic the file is an IPC stream
+    if data.to_pybytes()[:6] == b"ARROW1":
+        data = data[8:]
+    schema, batches = None, []
+    try:
+        with pa.ipc.open_stream(data) as stream:
+            schema = stream.schema
+            for batch in stream:
+                batches.append(batch)
+    except (pa.ArrowInvalid, OSError):
+        #truncated batch left by a crash, keep the complete ones
+        logging.warning(f"dropping an incomplete record batch of {path}")
+    return schema, batches
+
+
+def guess_format(path):
+    ext = os.path.splitext(path)[1]
+    return {".csv": "csv", ".arrow": "arrow"}.get(ext, "txt")
+
+
+def read_results(path, columns=None, fmt=None):
+    """Load a result file as a DataFrame, optionally only some columns."""
+    import pandas as pd
+    fmt = fmt or guess_format(path)
+    if fmt == "csv":
+        dtype = {"sample ID": str}
+        df = pd.read_csv(path, usecols=columns, dtype=dtype, float_precision='round_trip')
+    elif fmt == "arrow":
+        import pyarrow as pa
+        schema, batches = arrow_batches(path)
+        df = pa.Table.from_batches(batches, schema=schema).to_pandas()
+        if columns:
+            df = df[columns]
+    else:
+        #legacy txt output of the fit results, columns are positional
+        names = result_columns()[:1+len(models)*len(fit_columns)]
+        return pd.read_csv(path, sep=' ', index_col=False, names=names, usecols=columns)
+    #numeric toy IDs like the legacy format
+    if "sample ID" in df:
+        try:
+            df["sample ID"] = pd.to_numeric(df["sample ID"])
+        except ValueError:
+            pass
+    return df
+
+
+def build_index(path, fmt=None):
+    """Scan a result file once and write its sidecar index, e.g. for merged shards."""
+    fmt = fmt or guess_format(path)
+    entries = []
+    if fmt == "arrow":
+        for i, batch in enumerate(arrow_batches(path)[1]):
+            entries += [(toy_ID, i, row) for row, toy_ID in enumerate(batch.column(0).to_pylist())]
+    else:
+        with open(path, 'rb') as _f:
+            if fmt == "csv":
+                _f.readline()
+            offset = _f.tell()
+            for line in _f:
+                if not line.endswith(b'\n'):
+                    break
+                entries.append((line.split(b',' if fmt == "csv" else b' ', 1)[0].decode(), offset))
+                offset += len(line)
+    with open(index_path(path), 'w') as _f:
+        _f.write(''.join(' '.join(str(x) for x in entry)+'\n' for entry in entries))
+
+
+def toy_sort_key(toy_ID):
+    try:
+        return (0, int(toy_ID), toy_ID)
+    except ValueError:
+        return (1, 0, toy_ID)
+
+
+def merge_shards(paths, output, fmt=None, sort=False):
+    """Merge result files of the same format, e.g. the --chunk i/N shards, and index the output.
+
+    csv shards must share the header, arrow shards the schema. Rows keep the
+    shard order unless sort. Returns the toy IDs of the merged rows.
+    """
+    fmt = fmt or guess_format(output)
+    if fmt == "arrow":
+        import pyarrow as pa
+        import pyarrow.ipc
+        batches, schema = [], None
+        for path in paths:
+            shard_schema, shard_batches = arrow_batches(path)
+            if schema is None:
+                schema = shard_schema
+            elif shard_schema != schema:
+                raise ValueError(f"{path} was not written with the same columns as {paths[0]}")
+            batches += shard_batches
+        if schema is None:
+            raise ValueError("no shards to merge")
+        table = pa.Table.from_batches(batches, schema=schema)
+        toy_IDs = table.column(0).to_pylist()
+        if sort:
+            order = sorted(range(len(toy_IDs)), key=lambda i: toy_sort_key(toy_IDs[i]))
+            table = table.take(order)
+            toy_IDs = [toy_IDs[i] for i in order]
+        with pa.OSFile(output, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table, max_chunksize=100)
+    else:
+        separator = ',' if fmt == "csv" else ' '
+        header, rows = None, []
+        for path in paths:
+            with open(path, 'r') as _f:
+                lines = _f.readlines()
+            if fmt == "csv":
+                if not lines:
+                    raise ValueError(f"{path} has no header")
+                if header is None:
+                    header = lines[0]
+                elif lines[0] != header:
+                    raise ValueError(f"{path} was not written with the same columns as {paths[0]}")
+                lines = lines[1:]
+            if lines and not lines[-1].endswith('\n'):
+                logging.warning(f"dropping the incomplete last row of {path}")
+                lines = lines[:-1]
+            rows += [line for line in lines if line.strip()]
+        toy_IDs = [line.split(separator, 1)[0] for line in rows]
+        if sort:
+            order = sorted(range(len(rows)), key=lambda i: toy_sort_key(toy_IDs[i]))
+            rows = [rows[i] for i in order]
+            toy_IDs = [toy_IDs[i] for i in order]
+        with open(output, 'w') as _f:
+            _f.writelines(([header] if header else []) + rows)
+    build_index(output, fmt)
+    return toy_IDs
+
+
+def load_index(path, fmt=None):
+    """{toy_ID: offset or (batch, row)} of a result file, the index is built if missing."""
+    if not os.path.exists(index_path(path)) or os.path.getmtime(index_path(path)) < os.path.getmtime(path) - 1:
+        logging.info(f"indexing {path}")
+        build_index(path, fmt)
+    index = {}
+    with open(index_path(path), 'r') as _f:
+        for line in _f:
+            entry = line.split()
+            index[entry[0]] = int(entry[1]) if len(entry) == 2 else (int(entry[1]), int(entry[2]))
+    return index
+
+
+def read_samples(path, toy_IDs, columns=None, fmt=None):
+    """Rows of some toys as a DataFrame in the order of toy_IDs, read through the index."""
+    import pandas as pd
+    fmt = fmt or guess_format(path)
+    index = load_index(path, fmt)
+    missing = [toy_ID for toy_ID in toy_IDs if str(toy_ID) not in index]
+    if missing:
+        logging.warning(f"toys {missing} are not in {path}")
+    toy_IDs = [str(toy_ID) for toy_ID in toy_IDs if str(toy_ID) in index]
+
+    if fmt == "arrow":
+        import pyarrow as pa
+        import pyarrow.ipc
+        wanted = {}
+        for toy_ID in toy_IDs:
+            batch, row = index[toy_ID]
+            wanted.setdefault(batch, []).append(row)
+        try:
+            #only the wanted batches are read
+            with pa.OSFile(path) as source:
+                reader = pa.ipc.open_file(source)
+                tables = {i: reader.get_batch(i) for i in wanted}
+        except pa.ArrowInvalid:
+            #no footer yet, e.g. a job still running
+            batches = arrow_batches(path)[1]
+            tables = {i: batches[i] for i in wanted}
+        df = pd.DataFrame([tables[index[toy_ID][0]].slice(index[toy_ID][1], 1).to_pylist()[0] for toy_ID in toy_IDs],
+                          columns=tables[next(iter(tables))].schema.names if tables else None)
+        if columns:
+            df = df[columns]
+    else:
+        with open(path, 'rb') as _f:
+            header = _f.readline().decode() if fmt == "csv" else ''
+            lines = []
+            for toy_ID in toy_IDs:
+                _f.seek(index[toy_ID])
+                lines.append(_f.readline().decode())
+        text = io.StringIO(header + ''.join(lines))
+        if fmt == "csv":
+            df = pd.read_csv(text, usecols=columns, dtype={"sample ID": str}, float_precision='round_trip')
+        else:
+            names = result_columns()[:1+len(models)*len(fit_columns)]
+            return pd.read_csv(text, sep=' ', index_col=False, names=names, usecols=columns)
+    if "sample ID" in df:
+        try:
+            df["sample ID"] = pd.to_numeric(df["sample ID"])
+        except ValueError:
+            pass
+    return df
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# generate pseudo-datasets from a reference histogram with an injected
+# signal and fit them in memory, no toy files are written
+#
+# toy i is drawn from its own random stream SeedSequence(seed, spawn_key=(i,)),
+# so a toy does not depend on the batch size, --first_id sharding or --resume
+
+import sys
+import argparse
+import logging
+
+import numpy as np
+
+from liv_models import models, get_joint_group, load_extra_models
+import liv_fast_fit
+from liv_hist_reader import get_reader, readers
+from liv_result_writer import ensemble_rows, guess_format, joint_rows, open_writer, writers
+
+
+def toy_rng(seed, toy_ID):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(toy_ID,)))
+
+
+def inject(edges, contents, model_str=None, mu=0., integrate=False):
+    """Expected contents of the reference with the signal 1+mu*T of a model."""
+    contents = np.asarray(contents, dtype=float)
+    if model_str is None or mu == 0.:
+        return contents.copy()
+    template = liv_fast_fit.model_templates(edges, [model_str], integrate)[0]
+    return contents*(1. + mu*template)
+
+
+def generate_toys(expected, sigma, toy_IDs, seed=0):
+    """Gaussian pseudo-datasets around expected, shape (len(toy_IDs), n_bins)."""
+    toys = np.empty((len(toy_IDs), len(expected)))
+    for i, toy_ID in enumerate(toy_IDs):
+        toys[i] = toy_rng(seed, toy_ID).standard_normal(len(expected))
+    return expected + sigma*toys
+
+
+def flat_reference(n_bins=24, rel_error=1e-3, sday_max=6.28319):
+    """Asimov double ratio of 1 in every bin, for studies without a reference file."""
+    edges = np.linspace(0., sday_max, n_bins+1)
+    return edges, np.ones(n_bins), np.full(n_bins, rel_error**2)
+
+
+def toy_fit(coms=None):
+    argparser = argparse.ArgumentParser(description='generate and fit toys from a reference histogram')
+    argparser.add_argument('--reference', default=None, type=str,
+                           help='file with the Asimov/reference histogram, flat 1 if not given')
+    argparser.add_argument('--h_name', default="h_generated", help='histogram name')
+    argparser.add_argument('--reader', default="root", choices=sorted(readers),
+                           help='reader of the reference, uproot and npz run without ROOT')
+    argparser.add_argument('--n_bins', type=int, default=24, help='bins of the flat reference')
+    argparser.add_argument('--rel_error', type=float, default=1e-3, help='bin error of the flat reference')
+    argparser.add_argument('--model', default=None, type=str, help='model of the injected signal')
+    argparser.add_argument('--mu', type=float, default=0., help='injected mu')
+    argparser.add_argument('--n_toys', type=int, default=1000, help='number of toys')
+    argparser.add_argument('--first_id', type=int, default=0, help='toy ID of the first toy')
+    argparser.add_argument('--seed', type=int, default=0, help='seed of the toy random streams')
+    argparser.add_argument('--batch_size', type=int, default=10000, help='toys generated and fitted at once')
+    argparser.add_argument('--output', required=True, type=str, help='output file name')
+    argparser.add_argument('--output_format', default=None, choices=sorted(writers),
+                           help='txt (legacy, with residual file), csv or arrow, default from the --output extension')
+    argparser.add_argument('--residual_output', default="residual_12func.txt",
+                           type=str, help='output file name of residual statistics, txt format only')
+    argparser.add_argument('--resume', action='store_true', default=False,
+                           help='keep toys already in a csv/arrow --output and only fit the rest')
+    argparser.add_argument('--integrate_bins', action='store_true', default=False,
+                           help='inject and fit the model averaged over each bin')
+    argparser.add_argument('--extra_models', default=None, type=str,
+                           help='json file {name: [cos, sin, cos2, sin2]} of additional models')
+    argparser.add_argument('--residual_diagnostics', action='store_true', default=False,
+                           help='also write residual pulls, runs test and Fourier power per model')
+    argparser.add_argument('--joint', default=None, nargs='+', type=str,
+                           help='joint fits of these groups instead of the single fits, see liv_fit_to_data.py')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    if args.extra_models:
+        load_extra_models(args.extra_models)
+    if args.model is not None and args.model not in models:
+        logging.error(f"unknown model {args.model}!")
+        sys.exit()
+    groups = {}
+    for spec in args.joint or []:
+        try:
+            groups[spec] = get_joint_group(spec)
+        except ValueError as e:
+            logging.error(f"{e}!")
+            sys.exit()
+
+    if args.reference:
+        edges, contents, sumw2 = get_reader(args.reader, args.h_name).read(args.reference)
+    else:
+        edges, contents, sumw2 = flat_reference(args.n_bins, args.rel_error)
+    expected = inject(edges, contents, args.model, args.mu, args.integrate_bins)
+    sigma = np.sqrt(sumw2)
+
+    try:
+        writer = open_writer(args.output_format or guess_format(args.output), args.output, args.residual_output,
+                             args.resume, args.residual_diagnostics, groups)
+    except ValueError as e:
+        logging.error(f"{e}!")
+        sys.exit()
+
+    toy_IDs = [toy_ID for toy_ID in range(args.first_id, args.first_id+args.n_toys)
+               if str(toy_ID) not in writer.done]
+    if writer.done:
+        logging.info(f"resuming {args.output}, {args.n_toys-len(toy_IDs)} toys already written")
+
+    errors = np.broadcast_to(sigma, (min(args.batch_size, max(len(toy_IDs), 1)), len(sigma)))
+    for start in range(0, len(toy_IDs), args.batch_size):
+        batch = toy_IDs[start:start+args.batch_size]
+        toys = generate_toys(expected, sigma, batch, args.seed)
+        if args.joint:
+            rows = [joint_rows(liv_fast_fit.fit_joint(edges, toys, errors[:len(batch)],
+                                                      liv_fast_fit.model_templates(edges, group, args.integrate_bins)))
+                    for group in groups.values()]
+            for toy_ID, row in zip(batch, np.concatenate(rows, axis=1).tolist()):
+                writer.write(toy_ID, row)
+        else:
+            results, residuals = ensemble_rows(liv_fast_fit.fit_ensemble(edges, toys, errors[:len(batch)],
+                                                                         diagnostics=args.residual_diagnostics,
+                                                                         integrate=args.integrate_bins))
+            for toy_ID, row, res in zip(batch, results, residuals):
+                writer.write(toy_ID, row, res)
+        logging.info(f"fitted {start+len(batch)}/{len(toy_IDs)} toys")
+    writer.close()
+
+
+def main():
+    toy_fit()
+
+if __name__=="__main__":
+    main()
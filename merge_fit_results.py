@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# merge output shards of liv_fit_to_data.py --chunk i/N
+# works for the fit results and the residual files, both start with the toy ID
+# txt, csv and arrow shards are merged by liv_result_writer, which also writes
+# the .idx of the merged file
+
+import sys
+import argparse
+import logging
+
+from liv_result_writer import merge_shards, guess_format, writers
+
+
+def merge_results(coms=None):
+    argparser = argparse.ArgumentParser(description='merge fit result shards')
+    argparser.add_argument('--inputs', required=True, nargs='+',
+                           type=str, help='shard files, in chunk order')
+    argparser.add_argument('--output', required=True,
+                           type=str, help='output file name')
+    argparser.add_argument('--output_format', default=None, choices=sorted(writers),
+                           help='format of the shards and the output, guessed from the --output extension by default')
+    argparser.add_argument('--sort', action='store_true', default=False,
+                           help='sort rows by toy ID instead of keeping the input order')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    fmt = args.output_format or guess_format(args.output)
+    try:
+        toy_IDs = merge_shards(args.inputs, args.output, fmt, args.sort)
+    except ValueError as e:
+        logging.error(f"{e}!")
+        sys.exit()
+
+    if len(toy_IDs) < 1:
+        logging.error("no rows found in the shards!")
+        sys.exit()
+
+    if len(set(toy_IDs)) != len(toy_IDs):
+        logging.warning("duplicated toy IDs in the shards!")
+
+
+def main():
+    merge_results()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# read every toy histogram once and write a memory-mappable pack,
+# fit it with liv_fit_to_data.py --input_pack
+
+import sys
+import argparse
+import logging
+
+from liv_fit_to_data import get_toy_ID
+from liv_hist_reader import get_reader, readers, write_pack
+
+
+def pack_hists(coms=None):
+    argparser = argparse.ArgumentParser(description='pack toy histograms into one array')
+    argparser.add_argument('--input_list',required=True,
+                           type=str, help='text file, contains list of root files')
+    argparser.add_argument('--output',required=True,
+                           type=str, help='output pack directory')
+    argparser.add_argument('--id_regex', required=True, type=str,
+                           help='regex <_seed(.+?).root> of root file name to find toy ID,')
+    argparser.add_argument('--h_name', default="h_generated", help='histogram name')
+    argparser.add_argument('--reader', default="root", choices=sorted(readers), help='histogram reader')
+    argparser.add_argument('--prefetch', type=int, default=0,
+                           help='number of files read ahead on background threads')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    toy_files = open(args.input_list, 'r')
+    root_list = [iFile.strip() for iFile in toy_files.readlines() if iFile.strip()]
+    toy_files.close()
+
+    if len(root_list)<1:
+        logging.error("root list is empty!")
+        sys.exit()
+
+    toy_IDs = [get_toy_ID(iFile, args.id_regex) for iFile in root_list]
+    try:
+        write_pack(args.output, get_reader(args.reader, args.h_name), root_list, toy_IDs, args.prefetch)
+    except ValueError as e:
+        logging.error(f"{e}!")
+        sys.exit()
+
+
+def main():
+    pack_hists()
+
+if __name__=="__main__":
+    main()
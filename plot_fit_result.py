@@ -2,27 +2,43 @@
 # coding: utf-8
 
 
-import pandas as pd
-#pd.options.display.float_format = '{:,.5e}'.format
-
-from matplotlib import ticker
-formatter = ticker.ScalarFormatter(useMathText=True)
-formatter.set_scientific(True)
-formatter.set_powerlimits((-1,1))
-
-import matplotlib.pyplot as plt
-params = {'legend.fontsize': 'x-large',
-         'axes.labelsize': 'x-large',
-         'axes.titlesize':20,
-         'xtick.labelsize':20,
-         'ytick.labelsize':20}
-plt.rcParams.update(params)
-
-import mplhep as hep
-#hep.style.use(hep.style.ROOT) # For now ROOT defaults to CMS
-# Or choose one of the experiment styles
-#hep.style.use(hep.style.ATLAS)
-plt.style.use(hep.style.ATLAS)
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
+import logging
+import os
+
+#matplotlib and mplhep are loaded by load_plotting when plots are made,
+#importing this file has no side effects
+plt = None
+hep = None
+formatter = None
+
+def load_plotting():
+    global plt, hep, formatter
+    if plt is not None:
+        return
+
+    from matplotlib import ticker
+    formatter = ticker.ScalarFormatter(useMathText=True)
+    formatter.set_scientific(True)
+    formatter.set_powerlimits((-1,1))
+
+    import matplotlib.pyplot as pyplot
+    plt = pyplot
+    params = {'legend.fontsize': 'x-large',
+             'axes.labelsize': 'x-large',
+             'axes.titlesize':20,
+             'xtick.labelsize':20,
+             'ytick.labelsize':20}
+    plt.rcParams.update(params)
+
+    import mplhep
+    hep = mplhep
+    #hep.style.use(hep.style.ROOT) # For now ROOT defaults to CMS
+    # Or choose one of the experiment styles
+    #hep.style.use(hep.style.ATLAS)
+    plt.style.use(hep.style.ATLAS)
 
 
 coef_latex = {
@@ -84,66 +100,82 @@ def plot_sample(ax, pd_data, sample_ID, truth=False):
  
 
 
-def plot_each_sample(pd_data, sp_ids):
+def plot_each_sample(pd_data, sp, lumi=None, output_dir="plots"):
+    #one figure per sample, so samples can be drawn in parallel
+    load_plotting()
     fig, axes =  plt.subplots(2,1,figsize=(5,12), gridspec_kw={'height_ratios': [1,2]})
-    for sp in sp_ids:
-        plot_sample(axes, pd_data, sp)
-        #axes[0].set_title("Sample %i"%sp)
-        axes[1].set_yticks(list(range(len(parameters)-4)), labels_latex[:-4])
-        axes[0].set_yticks(list(range(4)), labels_latex[-4:])
-        
-        #axes[1].set_xlabel("fitted value")
-        axes[1].set_xlabel("Sample %i"%sp, loc='center')
-        
-        axes[1].xaxis.set_major_formatter(formatter)
-        axes[0].xaxis.set_major_formatter(formatter)
-        
-        axes[0].xaxis.set_major_locator(plt.MaxNLocator(6))
-        axes[1].xaxis.set_major_locator(plt.MaxNLocator(6))
-        hep.atlas.text(text="Internal", loc=0, ax=axes[0])
-        hep.atlas.label(data=True, loc=0,lumi=args.lumi, com=13, ax=axes[0])
-        plt.savefig(f"plots/SigFit_summary_sample{sp}.pdf", bbox_inches='tight')
-        axes[0].cla()
-        axes[1].cla()
-        plt.cla()
-            
-
-
-import argparse
+    plot_sample(axes, pd_data, sp)
+    #axes[0].set_title("Sample %i"%sp)
+    axes[1].set_yticks(list(range(len(parameters)-4)), labels_latex[:-4])
+    axes[0].set_yticks(list(range(4)), labels_latex[-4:])
+    
+    #axes[1].set_xlabel("fitted value")
+    axes[1].set_xlabel("Sample %i"%sp, loc='center')
+    
+    axes[1].xaxis.set_major_formatter(formatter)
+    axes[0].xaxis.set_major_formatter(formatter)
+    
+    axes[0].xaxis.set_major_locator(plt.MaxNLocator(6))
+    axes[1].xaxis.set_major_locator(plt.MaxNLocator(6))
+    hep.atlas.text(text="Internal", loc=0, ax=axes[0])
+    hep.atlas.label(data=True, loc=0,lumi=lumi, com=13, ax=axes[0])
+    plt.savefig(f"{output_dir}/SigFit_summary_sample{sp}.pdf", bbox_inches='tight')
+    plt.close(fig)
+    return f"{output_dir}/SigFit_summary_sample{sp}.pdf"
 
-parser = argparse.ArgumentParser(description='Results based on many samples')
-parser.add_argument('--input_file', type=str, help='name of input files produced from fit script')
-parser.add_argument('--sample_ids', default=0, nargs='+', type=int, help='Sample ID')
-parser.add_argument('--print', default=False, action='store_true', help='print fit values')
-parser.add_argument('--lumi', default=None, help='ATLAS luminosity XXX in fb^-1 unit')
 
-args = parser.parse_args()
-            
-null_spurious_results = args.input_file
+from liv_result_writer import read_samples
 
-col_names = ["sample ID"]
 parameters = ["d[u,X,Z]", "d[u,Y,Z]", "d[u,X-Y,X-Y]", "d[u,X,Y]",
               "c[u,X,Z]", "c[u,Y,Z]", "c[u,X-Y,X-Y]", "c[u,X,Y]",
               "c[d,X,Z]", "c[d,Y,Z]", "c[d,X-Y,X-Y]", "c[d,X,Y]"]
+labels_latex = [coef_latex[l] for l in parameters ]
 
-for d in parameters:
-    col_names += [d, f"{d}_err", f"{d}_chi2_ndf", f"{d}_chi2_p0"]
-spurious_tests = pd.read_csv(null_spurious_results, sep=' ',index_col=False, names=col_names)
-Pars = spurious_tests[parameters]
 
+def plot_fit_result(coms=None):
+    parser = argparse.ArgumentParser(description='Results based on many samples')
+    parser.add_argument('--input_file', type=str, help='name of input files produced from fit script, txt, csv or arrow')
+    parser.add_argument('--sample_ids', default=[0], nargs='+', type=int, help='Sample ID')
+    parser.add_argument('--print', default=False, action='store_true', help='print fit values')
+    parser.add_argument('--lumi', default=None, help='ATLAS luminosity XXX in fb^-1 unit')
+    parser.add_argument('--output_dir', default="plots", type=str, help='plot directory')
+    parser.add_argument('--jobs', type=int, default=1, help='number of rendering processes')
 
-labels_latex = [coef_latex[l] for l in parameters ]
-plot_each_sample(spurious_tests, sp_ids=args.sample_ids)
+    if coms:
+        args = parser.parse_args(coms)
+    else:
+        args = parser.parse_args()
+
+    null_spurious_results = args.input_file
+
+    col_names = ["sample ID"]
+    for d in parameters:
+        col_names += [d, f"{d}_err"]
+    #only the requested rows, through the toy ID index of the result file
+    spurious_tests = read_samples(null_spurious_results, args.sample_ids, columns=col_names)
+    samples = {i: spurious_tests.iloc[[row]] for row, i in enumerate(spurious_tests["sample ID"])}
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    render = functools.partial(plot_each_sample, lumi=args.lumi, output_dir=args.output_dir)
+    if args.jobs > 1 and len(samples) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            written = list(pool.map(render, samples.values(), samples.keys()))
+    else:
+        written = [render(sample, sp) for sp, sample in samples.items()]
+    logging.info(f"rendered {len(written)} plots")
 
 
-if args.print:
-    for i in args.sample_ids:
-        _sample = spurious_tests[spurious_tests["sample ID"]==i]
-        #print starts
-        print(f"Sample {i}:            value           err    ")
-        for p in parameters[::-1]:
-            print(f"{p:12}: ", f"{_sample[p].values[0]: 1.4E} +/-", f"{_sample[p+'_err'].values[0]:1.4E}")
-        print('\n')
+    if args.print:
+        for i, _sample in samples.items():
+            #print starts
+            print(f"Sample {i}:            value           err    ")
+            for p in parameters[::-1]:
+                print(f"{p:12}: ", f"{_sample[p].values[0]: 1.4E} +/-", f"{_sample[p+'_err'].values[0]:1.4E}")
+            print('\n')
 
 
+def main():
+    plot_fit_result()
 
+if __name__=="__main__":
+    main()
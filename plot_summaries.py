@@ -2,28 +2,48 @@
 # coding: utf-8
 
 
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import logging
+import os
+
 import numpy as np
-#pd.options.display.float_format = '{:,.5e}'.format
-
-from matplotlib import ticker
-formatter = ticker.ScalarFormatter(useMathText=True)
-formatter.set_scientific(True)
-formatter.set_powerlimits((-1,1))
-
-import matplotlib.pyplot as plt
-params = {'legend.fontsize': 'x-large',
-         'axes.labelsize': 'x-large',
-         'axes.titlesize':20,
-         'xtick.labelsize':20,
-         'ytick.labelsize':20}
-plt.rcParams.update(params)
-
-import mplhep as hep
-#hep.style.use(hep.style.ROOT) # For now ROOT defaults to CMS
-# Or choose one of the experiment styles
-#hep.style.use(hep.style.ATLAS)
-plt.style.use(hep.style.ATLAS)
+
+#pandas, matplotlib and mplhep are loaded by load_plotting when plots are made,
+#importing this file has no side effects
+pd = None
+plt = None
+hep = None
+formatter = None
+
+def load_plotting():
+    global pd, plt, hep, formatter
+    if plt is not None:
+        return
+    import pandas
+    pd = pandas
+    #pd.options.display.float_format = '{:,.5e}'.format
+
+    from matplotlib import ticker
+    formatter = ticker.ScalarFormatter(useMathText=True)
+    formatter.set_scientific(True)
+    formatter.set_powerlimits((-1,1))
+
+    import matplotlib.pyplot as pyplot
+    plt = pyplot
+    params = {'legend.fontsize': 'x-large',
+             'axes.labelsize': 'x-large',
+             'axes.titlesize':20,
+             'xtick.labelsize':20,
+             'ytick.labelsize':20}
+    plt.rcParams.update(params)
+
+    import mplhep
+    hep = mplhep
+    #hep.style.use(hep.style.ROOT) # For now ROOT defaults to CMS
+    # Or choose one of the experiment styles
+    #hep.style.use(hep.style.ATLAS)
+    plt.style.use(hep.style.ATLAS)
 
 coef_latex = {
         "d[u,X,Z]" : r"$d_{\it u}^{\it X,Z}$",
@@ -84,128 +104,163 @@ def plot_sample(ax, pd_data, sample_ID, truth=False):
             
 
 
-import argparse
-
-parser = argparse.ArgumentParser(description='Results based on many samples')
-parser.add_argument('--input_file', type=str, help='name of input files produced from fit script')
-parser.add_argument('--lumi', default=None, help='ATLAS luminosity XXX in fb^-1 unit')
+from liv_result_writer import read_results
 
-args = parser.parse_args()
-            
-null_spurious_results = args.input_file
-
-col_names = ["sample ID"]
 parameters = ["d[u,X,Z]", "d[u,Y,Z]", "d[u,X-Y,X-Y]", "d[u,X,Y]",
               "c[u,X,Z]", "c[u,Y,Z]", "c[u,X-Y,X-Y]", "c[u,X,Y]",
               "c[d,X,Z]", "c[d,Y,Z]", "c[d,X-Y,X-Y]", "c[d,X,Y]"]
-for d in parameters:
-    col_names += [d, f"{d}_err", f"{d}_chi2", f"{d}_chi2_p0"]
-spurious_tests = pd.read_csv(null_spurious_results, sep=' ',index_col=False, names=col_names)
-Pars = spurious_tests[parameters]
 
 
+def ks_statistic(cdf):
+    """Kolmogorov-Smirnov D of every column, given the hypothesised cdf of the values."""
+    cdf = np.sort(cdf, axis=0)
+    n = len(cdf)
+    i = np.arange(1, n+1)[:, None]
+    return np.maximum((i/n - cdf).max(axis=0), (cdf - (i-1)/n).max(axis=0))
 
-pd_stats = pd.DataFrame()
-pd_stats["sample ID"] = [0]
-fig, axes =  plt.subplots(1,1,figsize=(6,6))
-#axes.xaxis.set_major_formatter(formatter)
-for d in parameters:
-    axes.hist(Pars[d].to_numpy(), bins=20, label=d)
-    plt.xlabel(r"coefficient"+coef_latex[d])
-    plt.ylabel("counts")
-    #plt.title("Null samples: spurious signal test")
-    #plt.xlim(-1e-5, 1e-5)
-    #plt.ylim(0, 40)
-    #plt.text(3e-6, 35, f"mean: {Pars[d].mean():.3e}")
-    #plt.text(3e-6, 30, f"std: {Pars[d].std():.3e}")
-    pd_stats[d] = Pars[d].mean()
-    pd_stats[f"{d}_err"] = Pars[d].std()
-    #plt.show()
-    plt.savefig(f"plots/distribution_plots_{d}.pdf", bbox_inches='tight')
-    plt.cla()
-
-#plot Err distributions
-fig, axes =  plt.subplots(1,1,figsize=(6,6))
-for d in parameters:
-    #axes.xaxis.set_major_formatter(formatter)
-    _values = spurious_tests[f"{d}"]
-    _errors = spurious_tests[f"{d}_err"]
-    _rel =_errors.to_numpy()/_values.to_numpy()
-    _rel = np.abs(_rel)
-    axes.hist(_errors, bins=20, label=coef_latex[d]+f": {_errors.mean()} ")
-    plt.legend()
-    #plt.xlabel(f"coefficient {d} - STD")
-    plt.ylabel("counts")
-    #plt.title("Null samples: spurious signal test")
-    #plt.xlim(-1e-5, 1e-5)
-    #plt.ylim(0, 40)
-    #plt.text(3e-6, 35, f"mean: {Pars[d].mean():.3e}")
-    #plt.text(3e-6, 30, f"std: {Pars[d].std():.3e}")
-    #pd_stats[d] = Pars[d].mean()
-    #pd_stats[f"{d}_err"] = Pars[d].std()
-    #plt.show()
-    plt.savefig(f"plots/distribution_plots_{d}_errs.pdf", bbox_inches='tight')
-    plt.cla()
-
-
-chi2_p0 = spurious_tests[[f"{i}_chi2_p0" for i in parameters]]
-fig, axes =  plt.subplots(1,1, sharey=True,figsize=(6,6))
-for d in parameters:
-    axes.hist(chi2_p0[f"{d}_chi2_p0"].to_numpy(), bins=20, label=d)
-    plt.xlabel("chi2_p0: "+coef_latex[d])
-    plt.ylabel("counts")
-    #plt.title("Null samples: spurious signal test")
-    #plt.xlim(-1e-5, 1e-5)
-    plt.ylim(0, 40)
-    #plt.text(3e-6, 35, f"mean: {chi2_p0[f'{d}_chi2_p0'].mean():.3e}")
-    #plt.text(3e-6, 30, f"std: {chi2_p0[f'{d}_chi2_p0'].std():.3e}")
-    #plt.show()
-    plt.savefig(f"plots/Stats_chi2_p0_test_{d}.pdf", bbox_inches='tight')
-    plt.cla()
-
-chi2 = spurious_tests[[f"{i}_chi2" for i in parameters]]
-fig, axes =  plt.subplots(1,1, sharey=True,figsize=(6,6))
-for d in parameters:
-    axes.hist(chi2[f"{d}_chi2"].to_numpy(), bins=20, label=d)
-    plt.xlabel("chi2: "+coef_latex[d])
+
+def summarise(results, truth=0., bins=20):
+    """All summary statistics of the parameters in one vectorised pass.
+
+    Returns a table with one row per parameter and the histograms
+    {(kind, parameter): (counts, edges)} of values, errors, pulls, chi2
+    and chi2 p-values. p-values are tested for uniformity and pulls
+    (value-truth)/err for a unit normal with the Kolmogorov-Smirnov test.
+    """
+    from scipy import special, stats
+    values = results[parameters].to_numpy(dtype=float)
+    errors = results[[f"{d}_err" for d in parameters]].to_numpy(dtype=float)
+    chi2 = results[[f"{d}_chi2" for d in parameters]].to_numpy(dtype=float)
+    chi2_p0 = results[[f"{d}_chi2_p0" for d in parameters]].to_numpy(dtype=float)
+    pulls = (values - truth)/errors
+    n = len(values)
+
+    p0_ks = ks_statistic(chi2_p0)
+    pull_ks = ks_statistic(special.ndtr(pulls))
+    table = pd.DataFrame({"n": n, "mean": values.mean(axis=0), "std": values.std(axis=0, ddof=1),
+                          "err_mean": errors.mean(axis=0), "err_std": errors.std(axis=0, ddof=1),
+                          "pull_mean": pulls.mean(axis=0), "pull_std": pulls.std(axis=0, ddof=1),
+                          "chi2_mean": chi2.mean(axis=0), "chi2_std": chi2.std(axis=0, ddof=1),
+                          "p0_ks_D": p0_ks, "p0_ks_p": stats.kstwo.sf(p0_ks, n),
+                          "pull_ks_D": pull_ks, "pull_ks_p": stats.kstwo.sf(pull_ks, n)},
+                         index=pd.Index(parameters, name="parameter"))
+
+    hists = {}
+    for kind, array in [("value", values), ("err", errors), ("pull", pulls), ("chi2", chi2), ("chi2_p0", chi2_p0)]:
+        for d, column in zip(parameters, array.T):
+            hists[(kind, d)] = np.histogram(column, bins=(bins if kind != "chi2_p0" else np.linspace(0, 1, bins+1)))
+    return table, hists
+
+
+def hist_tasks(table, hists, output_dir="plots"):
+    #file name, counts, edges, x label and legend of every distribution plot
+    tasks = []
+    for d in parameters:
+        tasks += [(f"{output_dir}/distribution_plots_{d}.pdf", *hists[("value", d)], r"coefficient"+coef_latex[d], None),
+                  (f"{output_dir}/distribution_plots_{d}_errs.pdf", *hists[("err", d)], None,
+                   coef_latex[d]+f": {table.loc[d, 'err_mean']} "),
+                  (f"{output_dir}/pull_distribution_{d}.pdf", *hists[("pull", d)], "pull: "+coef_latex[d],
+                   f"mean {table.loc[d, 'pull_mean']:.3f}, std {table.loc[d, 'pull_std']:.3f}"),
+                  (f"{output_dir}/Stats_chi2_p0_test_{d}.pdf", *hists[("chi2_p0", d)], "chi2_p0: "+coef_latex[d],
+                   f"KS p = {table.loc[d, 'p0_ks_p']:.3f}"),
+                  (f"{output_dir}/Stats_chi2_test_{d}.pdf", *hists[("chi2", d)], "chi2: "+coef_latex[d], None)]
+    return tasks
+
+
+def render_hist(task):
+    path, counts, edges, xlabel, label = task
+    load_plotting()
+    fig, axes =  plt.subplots(1,1,figsize=(6,6))
+    axes.stairs(counts, edges, fill=True, label=label)
+    if label:
+        plt.legend()
+    if xlabel:
+        plt.xlabel(xlabel)
     plt.ylabel("counts")
-    #plt.title("Null samples: spurious signal test")
-    #plt.xlim(-1e-5, 1e-5)
-    #plt.ylim(0, 40)
-    #plt.text(3e-6, 35, f"mean: {chi2_p0[f'{d}_chi2_p0'].mean():.3e}")
-    #plt.text(3e-6, 30, f"std: {chi2_p0[f'{d}_chi2_p0'].std():.3e}")
-    #plt.show()
-    plt.savefig(f"plots/Stats_chi2_test_{d}.pdf", bbox_inches='tight')
-    plt.cla()
+    plt.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+def render_overview(pd_stats, lumi=None, output_dir="plots"):
+    load_plotting()
+    sample_id=0
+    fig, axes =  plt.subplots(2,1,figsize=(5,12), gridspec_kw={'height_ratios': [1,2]})
+    plot_sample(axes, pd_stats, sample_id)
+    #axes[0].set_title("Sample %i"%sp)
+    labels_latex = [coef_latex[l] for l in parameters ]
+    axes[1].set_yticks(list(range(len(parameters)-4)), labels_latex[:-4])
+    axes[0].set_yticks(list(range(4)), labels_latex[-4:])
+
+    axes[1].set_xlabel(r"$\mu$", loc='center')
 
+    axes[1].xaxis.set_major_formatter(formatter)
+    axes[0].xaxis.set_major_formatter(formatter)
 
+    axes[0].xaxis.set_major_locator(plt.MaxNLocator(6))
+    axes[1].xaxis.set_major_locator(plt.MaxNLocator(6))
 
-sample_id=0
-fig, axes =  plt.subplots(2,1,figsize=(5,12), gridspec_kw={'height_ratios': [1,2]})
-plot_sample(axes, pd_stats, sample_id)
-#axes[0].set_title("Sample %i"%sp)
-labels_latex = [coef_latex[l] for l in parameters ]
-axes[1].set_yticks(list(range(len(parameters)-4)), labels_latex[:-4])
-axes[0].set_yticks(list(range(4)), labels_latex[-4:])
-        
-axes[1].set_xlabel(r"$\mu$", loc='center')
-        
-axes[1].xaxis.set_major_formatter(formatter)
-axes[0].xaxis.set_major_formatter(formatter)
+    hep.atlas.text(text="Internal", loc=0, ax=axes[0])
+    hep.atlas.label(data=True, loc=0,lumi=lumi, com=13, ax=axes[0])
 
-axes[0].xaxis.set_major_locator(plt.MaxNLocator(6))
-axes[1].xaxis.set_major_locator(plt.MaxNLocator(6))
+    plt.savefig(f"{output_dir}/SigFit_summary_AllSamples.pdf", bbox_inches='tight')
+    plt.close(fig)
+    return f"{output_dir}/SigFit_summary_AllSamples.pdf"
 
-hep.atlas.text(text="Internal", loc=0, ax=axes[0])
-hep.atlas.label(data=True, loc=0,lumi=args.lumi, com=13, ax=axes[0])
 
-plt.savefig(f"plots/SigFit_summary_AllSamples.pdf", bbox_inches='tight')
+def plot_summaries(coms=None):
+    parser = argparse.ArgumentParser(description='Results based on many samples')
+    parser.add_argument('--input_file', type=str, help='name of input files produced from fit script, txt, csv or arrow')
+    parser.add_argument('--lumi', default=None, help='ATLAS luminosity XXX in fb^-1 unit')
+    parser.add_argument('--output_dir', default="plots", type=str, help='plot directory')
+    parser.add_argument('--summary_output', default=None, type=str,
+                        help='csv table of the summary statistics, <output_dir>/summary_stats.csv by default')
+    parser.add_argument('--truth', type=float, default=0., help='true value of every parameter for the pulls')
+    parser.add_argument('--bins', type=int, default=20, help='histogram bins')
+    parser.add_argument('--jobs', type=int, default=1, help='number of rendering processes')
+
+    if coms:
+        args = parser.parse_args(coms)
+    else:
+        args = parser.parse_args()
+    load_plotting()
+
+    null_spurious_results = args.input_file
+
+    col_names = ["sample ID"]
+    for d in parameters:
+        col_names += [d, f"{d}_err", f"{d}_chi2", f"{d}_chi2_p0"]
+    spurious_tests = read_results(null_spurious_results, columns=col_names)
+
+    table, hists = summarise(spurious_tests, truth=args.truth, bins=args.bins)
+    os.makedirs(args.output_dir, exist_ok=True)
+    table.to_csv(args.summary_output or os.path.join(args.output_dir, "summary_stats.csv"))
+
+    pd_stats = pd.DataFrame()
+    pd_stats["sample ID"] = [0]
+    for d in parameters:
+        pd_stats[d] = table.loc[d, "mean"]
+        pd_stats[f"{d}_err"] = table.loc[d, "std"]
+
+    tasks = hist_tasks(table, hists, args.output_dir)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            overview = pool.submit(render_overview, pd_stats, args.lumi, args.output_dir)
+            written = list(pool.map(render_hist, tasks, chunksize=max(1, len(tasks)//(4*args.jobs))))
+            written.append(overview.result())
+    else:
+        written = [render_hist(task) for task in tasks] + [render_overview(pd_stats, args.lumi, args.output_dir)]
+    logging.info(f"rendered {len(written)} plots")
 
 
-#print starts
-print("                value           err    ")
-for p in parameters[::-1]:
-    print(f"{p:12}: ", f"{pd_stats[p].loc[0]: 1.4E} +/-", f"{pd_stats[p+'_err'].loc[0]:1.4E}")
+    #print starts
+    print("                value           err    ")
+    for p in parameters[::-1]:
+        print(f"{p:12}: ", f"{pd_stats[p].loc[0]: 1.4E} +/-", f"{pd_stats[p+'_err'].loc[0]:1.4E}")
 
 
+def main():
+    plot_summaries()
 
+if __name__=="__main__":
+    main()
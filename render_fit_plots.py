@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# render fit, residual and chi2 profile plots from the artefacts stored by
+# liv_fit_to_data.py --defer_plots, outside of the fitting loop
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import functools
+import glob
+import logging
+import os
+
+import numpy as np
+
+#matplotlib and mplhep are loaded by load_plotting when plots are made,
+#importing this file has no side effects
+plt = None
+hep = None
+
+def load_plotting():
+    global plt, hep
+    if plt is not None:
+        return
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as pyplot
+    plt = pyplot
+    import mplhep
+    hep = mplhep
+    plt.style.use(hep.style.ATLAS)
+
+
+def draw_fit(ax, a, i, model_str, lumi=None):
+    edges, contents, errors = a["edges"], a["contents"], a["errors"]
+    centres = 0.5*(edges[1:] + edges[:-1])
+    MaxDelta = max(abs(1-contents.max())*2., abs(1-contents.min())*2.)
+
+    #model curve, normalised like the prediction in the bins
+    x = np.linspace(edges[0], edges[-1], 300)
+    template = np.dot(a["vectors"][i], [np.cos(x), np.sin(x), np.cos(2*x), np.sin(2*x)])
+    curve = np.mean(a["scale"])*(1. + a["par"][i]*template)
+
+    ax.errorbar(centres, contents, xerr=0.5*np.diff(edges), yerr=errors, fmt='o', color='black', label="Data")
+    ax.plot(x, curve, color='blue', label="Fit")
+    ax.set_xlim(edges[0], edges[-1])
+    ax.set_ylim(1-MaxDelta, 1+MaxDelta)
+    ax.set_ylabel("R")
+    ax.set_title(model_str)
+    hep.atlas.text(text="Internal", loc=0, ax=ax)
+    hep.atlas.label(data=True, loc=0, lumi=lumi, com=13, ax=ax)
+
+
+def render_toy(path, output_dir="plots", ratio_plot=False, lumi=None):
+    #once per process, also in the rendering workers
+    load_plotting()
+    with np.load(path) as a:
+        a = dict(a)
+    toy_ID = str(a["toy_ID"])
+    edges = a["edges"]
+    centres = 0.5*(edges[1:] + edges[:-1])
+    written = []
+
+    for i, model_str in enumerate(a["models"]):
+        model_str = str(model_str)
+        if ratio_plot:
+            fig, (Upad, Lpad) = plt.subplots(2, 1, sharex=True, figsize=(8, 8),
+                                             gridspec_kw={'height_ratios': [2, 1], 'hspace': 0.05})
+            draw_fit(Upad, a, i, model_str, lumi)
+            res = a["residuals"][i]
+            res_mean, res_std = np.mean(res), np.std(res)
+            band = edges[[0, -1]]
+            Lpad.fill_between(band, res_mean-2*res_std, res_mean+2*res_std, color='green')
+            Lpad.fill_between(band, res_mean-res_std, res_mean+res_std, color='yellow')
+            Lpad.errorbar(centres, res, yerr=a["errors"], fmt='o', color='black')
+            Lpad.axhline(0, color='k')
+            Lpad.set_ylim(res_mean-3.5*res_std, res_mean+3.5*res_std)
+            Lpad.set_ylabel("Data-Fit")
+            Lpad.set_xlabel(r"$\omega T$")
+            written.append(os.path.join(output_dir, f"fit_results_{model_str}_{toy_ID}_residual_12func.pdf"))
+            fig.savefig(written[-1], bbox_inches='tight')
+            plt.close(fig)
+
+        fig, ax = plt.subplots(1, 1, figsize=(8, 6))
+        draw_fit(ax, a, i, model_str, lumi)
+        ax.set_xlabel(r"$\omega T$")
+        written.append(os.path.join(output_dir, f"fit_results_{model_str}_{toy_ID}_12func.pdf"))
+        fig.savefig(written[-1], bbox_inches='tight')
+        plt.close(fig)
+
+        #chi2 profile of mu
+        fig, ax = plt.subplots(1, 1, figsize=(8, 6))
+        profile = a["profile"][i]
+        ax.plot(a["mu_grid"][i], profile - profile.min(), color='r')
+        ax.set_xlabel(r"$\mu$")
+        ax.set_ylabel(r"$\Delta\chi^2$")
+        ax.set_title(model_str)
+        hep.atlas.text(text="Internal", loc=0, ax=ax)
+        written.append(os.path.join(output_dir, f"profile_chi2PDF_{model_str}_{toy_ID}_12func.pdf"))
+        fig.savefig(written[-1], bbox_inches='tight')
+        plt.close(fig)
+    return written
+
+
+def render_plots(coms=None):
+    argparser = argparse.ArgumentParser(description='render plots of deferred fits')
+    argparser.add_argument('--artefact_dir', required=True,
+                           type=str, help='directory given to liv_fit_to_data.py --defer_plots')
+    argparser.add_argument('--output_dir', default="plots", type=str, help='plot directory')
+    argparser.add_argument('--ratio_plot', action='store_true', default=False, help='also plot residuals')
+    argparser.add_argument('--lumi', default=None, help='ATLAS luminosity XXX in fb^-1 unit')
+    argparser.add_argument('--jobs', type=int, default=1, help='number of rendering processes')
+
+    if coms:
+        args = argparser.parse_args(coms)
+    else:
+        args = argparser.parse_args()
+
+    artefacts = sorted(glob.glob(os.path.join(args.artefact_dir, "toy_*.npz")))
+    if len(artefacts) < 1:
+        logging.error("no plot artefacts found!")
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    render = functools.partial(render_toy, output_dir=args.output_dir,
+                               ratio_plot=args.ratio_plot, lumi=args.lumi)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            written = list(pool.map(render, artefacts))
+    else:
+        written = [render(path) for path in artefacts]
+    logging.info(f"rendered {sum(len(w) for w in written)} plots")
+
+
+def main():
+    render_plots()
+
+if __name__=="__main__":
+    main()